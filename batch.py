@@ -0,0 +1,125 @@
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from create_epub import create_epub_from_textfile
+from create_epub_json import create_epub
+from epub_writer import COMPRESS_LEVEL
+
+INPUT_NAMES = ["input_pre.txt", "input_pre.json"]
+
+def find_books(directory):
+    # Every folder below directory that holds one of the pre-processed inputs is a book.
+    books = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in INPUT_NAMES:
+            if name in files:
+                books.append({"input": os.path.join(root, name)})
+                break
+    return books
+
+def read_manifest(path):
+    # A JSON list of books, each with an "input" path and optional "metadata", "cover" and "output" paths,
+    # relative to the manifest.
+    base = os.path.dirname(path)
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    return [{key: os.path.join(base, value) for key, value in entry.items()} for entry in entries]
+
+def convert_book(book):
+    # Runs in a worker process. Failures are returned instead of raised, so one bad book does not stop the batch.
+    folder = os.path.dirname(book["input"])
+    metadata_path = book.get("metadata", os.path.join(folder, "metadata.json"))
+    cover_path = book.get("cover", os.path.join(folder, "cover.jpg"))
+    output_path = book["output"]
+    level = book.get("compress_level", COMPRESS_LEVEL)
+    start = time.perf_counter()
+    try:
+        if book["input"].endswith(".json"):
+            create_epub(book["input"], cover_path, metadata_path=metadata_path, output_path=output_path, cache_dir=book.get("cache_dir"), compress_level=level)
+        else:
+            create_epub_from_textfile(book["input"], metadata_path, cover_path, output_path=output_path, cache_dir=book.get("cache_dir"), compress_level=level)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return {"input": book["input"], "output": output_path, "seconds": time.perf_counter() - start,
+            "bytes": os.path.getsize(book["input"]) if os.path.exists(book["input"]) else 0, "error": error}
+
+def output_names(folders):
+    # EPUB names for books written to one output directory: the folder name, with the names of parent
+    # folders in front where names collide (a_book.epub and b_book.epub), and a number as the last resort.
+    parts = [os.path.abspath(folder).strip(os.sep).split(os.sep) for folder in folders]
+    depths = [1] * len(folders)
+    while True:
+        names = ["_".join(path[-depth:]) for path, depth in zip(parts, depths)]
+        counts = Counter(names)
+        grow = [i for i, name in enumerate(names) if counts[name] > 1 and depths[i] < len(parts[i])]
+        if not grow:
+            break
+        for i in grow:
+            depths[i] += 1
+    seen = Counter()
+    result = []
+    for name in names:
+        seen[name] += 1
+        result.append(f"{name}_{seen[name]}.epub" if counts[name] > 1 else f"{name}.epub")
+    return result
+
+def run_batch(books, output_dir=None, workers=None, cache_dir=None, compress_level=COMPRESS_LEVEL):
+    # Books are spread over a pool of worker processes that import the builders once and then take book after book.
+    unnamed = [book for book in books if "output" not in book]
+    folders = [os.path.dirname(book["input"]) for book in unnamed]
+    if output_dir:
+        for book, name in zip(unnamed, output_names(folders)):
+            book["output"] = os.path.join(output_dir, name)
+    else:
+        for book, folder in zip(unnamed, folders):
+            book["output"] = os.path.join(folder, os.path.basename(os.path.abspath(folder)) + ".epub")
+    duplicates = [path for path, count in Counter(os.path.abspath(book["output"]) for book in books).items() if count > 1]
+    if duplicates:
+        raise ValueError(f"Several books would be written to {', '.join(sorted(duplicates))}")
+    for book in books:
+        if cache_dir:
+            book["cache_dir"] = cache_dir
+        book["compress_level"] = compress_level
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(convert_book, books):
+            if result["error"]:
+                print(f"FAILED {result['input']}: {result['error']}")
+            else:
+                print(f"{result['seconds']:7.2f} s  {result['output']}")
+            results.append(result)
+    elapsed = time.perf_counter() - start
+    if not results:
+        print("No books found")
+        return results
+    failed = sum(1 for result in results if result["error"])
+    megabytes = sum(result["bytes"] for result in results) / 1e6
+    print(f"Converted {len(results) - failed} of {len(results)} books in {elapsed:.1f} s "
+          f"({len(results) / elapsed:.2f} books/s, {megabytes / elapsed:.2f} MB/s), {failed} failed")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert many books to EPUB in a pool of worker processes.")
+    parser.add_argument("source", help="a directory of book folders, or a JSON manifest")
+    parser.add_argument("--output-dir", help="write all EPUBs here instead of into each book folder")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--cache-dir", help="chapter cache shared by all books")
+    parser.add_argument("--report", help="also write the per-book results to this JSON file")
+    parser.add_argument("--compress-level", type=int, default=COMPRESS_LEVEL, choices=range(10), help="deflate level of the EPUBs, 1 fastest, 9 smallest")
+    args = parser.parse_args()
+    books = read_manifest(args.source) if os.path.isfile(args.source) else find_books(args.source)
+    results = run_batch(books, args.output_dir, args.workers, args.cache_dir, args.compress_level)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if any(result["error"] for result in results):
+        sys.exit(1)
@@ -0,0 +1,269 @@
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from bs4 import BeautifulSoup
+from create_epub import create_epub_from_textfile
+from create_epub_json import create_epub, parse_inline
+from blocks import blocks_path, compare_blocks, read_blocks
+from validate_epub import validate_epub
+from footnote_refs import extract_tokens
+from generate_corpus import write_corpus
+from page_numbering import page_index_path, process_file as number_pages
+from pre_processing import process_file
+
+def write_single_chapter(path, paragraphs):
+    with open(path, "w") as f:
+        f.write("<h1>Chapter 1</h1>\n<1>\n\n")
+        for i in range(paragraphs):
+            f.write(f"<body>Paragraph {i} of a single very long chapter, with enough words to look like prose.</body>\n<{i // 20 + 1}>\n\n")
+
+# Timing differences below this are treated as noise when looking for regressions.
+MIN_SECONDS = 0.01
+# The scaling checks fail when the time per item of a larger size is more than this much above the smallest size.
+SCALING_THRESHOLD = 1.0
+
+def find_nonlinear(results, unit, threshold=SCALING_THRESHOLD):
+    # Lists the sizes whose time per item grew past the threshold, which means worse than linear scaling.
+    count, elapsed = results[0]
+    limit = elapsed / count * (1 + threshold)
+    return [f"{size} {unit}: {seconds / size * 1e6:.1f} us per item, against {elapsed / count * 1e6:.1f} at {count}"
+            for size, seconds in results[1:] if seconds - MIN_SECONDS > size * limit]
+
+def bench_large_chapter(sizes=(2500, 5000, 10000, 20000)):
+    # Build time should grow linearly with the paragraph count, so time per paragraph should stay flat.
+    # The EPUB check is left out, it is timed as a stage of its own.
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            with open("metadata.json", "w") as f:
+                json.dump({"title": "Benchmark"}, f)
+            for paragraphs in sizes:
+                write_single_chapter("input_pre.txt", paragraphs)
+                start = time.perf_counter()
+                create_epub_from_textfile("input_pre.txt", "metadata.json", "cover.jpg", validate=False)
+                elapsed = time.perf_counter() - start
+                results.append((paragraphs, elapsed))
+        finally:
+            os.chdir(cwd)
+    for paragraphs, elapsed in results:
+        print(f"{paragraphs:>8} paragraphs  {elapsed:8.3f} s  {elapsed / paragraphs * 1e6:8.1f} us/paragraph")
+    return results
+
+def write_hyphenated_blocks(path, blocks):
+    # Every block is split over two lines with a hyphen break, and every tenth block ends in a hyphen
+    # whose word continues in the next block of the same tag, which is often far away.
+    with open(path, "w") as f:
+        for i in range(blocks):
+            tag = "footer" if i % 50 == 0 else "body"
+            ending = "con-" if i % 10 == 0 else "end."
+            f.write(f"<{tag}>Block {i} starts here and is hy-\n  phenated across two lines, {ending}</{tag}>\n<{i // 20 + 1}>\n\n")
+
+def bench_pre_processing(sizes=(5000, 10000, 20000, 40000)):
+    # Time per block should stay flat as the document grows.
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, "input.txt")
+        output_path = os.path.join(tmp, "input_pre.txt")
+        for blocks in sizes:
+            write_hyphenated_blocks(input_path, blocks)
+            start = time.perf_counter()
+            process_file(input_path, output_path)
+            elapsed = time.perf_counter() - start
+            results.append((blocks, elapsed))
+    for blocks, elapsed in results:
+        print(f"{blocks:>8} blocks      {elapsed:8.3f} s  {elapsed / blocks * 1e6:8.1f} us/block")
+    return results
+
+def measure(function, memory=True, repeat=3):
+    # Best wall time of plain runs, then peak traced memory of one more run, since tracing slows everything down.
+    elapsed = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = min(elapsed, time.perf_counter() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return elapsed, peak
+
+def read_text(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+def build_json(input_path, metadata_path, output_path):
+    # Without the block file the JSON builder keeps from its last run, so the stage includes decoding.
+    if os.path.exists(blocks_path(input_path)):
+        os.remove(blocks_path(input_path))
+    create_epub(input_path, "cover.jpg", metadata_path=metadata_path, output_path=output_path, validate=False)
+
+def bench_stages(sizes=(100, 300, 1000), memory=True, repeat=3):
+    # Every stage on generated books of each size, in the order the stages run on a real book.
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        metadata_path = os.path.join(tmp, "metadata.json")
+        with open(metadata_path, "w") as f:
+            json.dump({"title": "Benchmark"}, f)
+        paths = {name: os.path.join(tmp, name) for name in
+                 ("input.txt", "input_page.txt", "input_pre.txt", "input_pre.json", "book.epub", "book_json.epub")}
+        for pages in sizes:
+            write_corpus(paths["input.txt"], paths["input_pre.json"], pages=pages)
+            stages = [
+                ("page_numbering", lambda: number_pages(paths["input.txt"], paths["input_page.txt"])),
+                ("pre_processing", lambda: process_file(paths["input_page.txt"], paths["input_pre.txt"])),
+                ("footnote_tokens", lambda: extract_tokens(read_text(paths["input_pre.txt"]))),
+                ("create_epub", lambda: create_epub_from_textfile(paths["input_pre.txt"], metadata_path, "cover.jpg",
+                                                                  output_path=paths["book.epub"], validate=False)),
+                ("create_epub_json", lambda: build_json(paths["input_pre.json"], metadata_path, paths["book_json.epub"])),
+                ("validate_epub", lambda: validate_epub(paths["book.epub"])),
+            ]
+            for stage, function in stages:
+                elapsed, peak = measure(function, memory, repeat)
+                results.append({"stage": stage, "pages": pages, "seconds": round(elapsed, 4),
+                                "peak_mb": round(peak / 1e6, 2) if peak is not None else None})
+    for result in results:
+        peak = f"{result['peak_mb']:8.1f} MB" if result["peak_mb"] is not None else ""
+        print(f"{result['stage']:>18} {result['pages']:>6} pages  {result['seconds']:8.3f} s  "
+              f"{result['seconds'] / result['pages'] * 1e3:7.2f} ms/page  {peak}")
+    return results
+
+def find_regressions(results, baseline, threshold):
+    # Compares against an earlier results file and lists every stage that got slower or bigger than allowed.
+    previous = {(result["stage"], result["pages"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["stage"], result["pages"]))
+        if not old:
+            continue
+        for field in ("seconds", "peak_mb"):
+            if result[field] is None or not old.get(field):
+                continue
+            limit = old[field] * (1 + threshold) + (MIN_SECONDS if field == "seconds" else 0)
+            if result[field] > limit:
+                regressions.append(f"{result['stage']} at {result['pages']} pages: {field} {old[field]} -> {result[field]}")
+    return regressions
+
+modified_pattern = re.compile(rb'dcterms:modified">[^<]*')
+
+def epub_differences(path, reference):
+    # Entries of two EPUBs that differ, ignoring the modification time in the package document.
+    def entries(epub_path):
+        with zipfile.ZipFile(epub_path) as z:
+            return {name: modified_pattern.sub(b"", z.read(name)) for name in z.namelist()}
+    a, b = entries(path), entries(reference)
+    return sorted(name for name in a.keys() | b.keys() if a.get(name) != b.get(name))
+
+def check_inline(samples=5000, seed=0):
+    # parse_inline must give the same nodes as the full parse it replaces for plain and simple records.
+    rng = random.Random(seed)
+    pieces = ["word", " ", "  ", "\n", "<i>", "</i>", "<b>", "</b>", "<sup>", "</sup>", "<em>", "</em>",
+              "<span>", "</span>", "&amp;", "<", ">", "1"]
+    problems = []
+    for _ in range(samples):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 12)))
+        soup = BeautifulSoup("", "html.parser")
+        fast = soup.new_tag("p")
+        fast.extend(parse_inline(soup, text))
+        full = soup.new_tag("p")
+        full.append(BeautifulSoup(text, "html.parser"))
+        if str(fast) != str(full):
+            problems.append(f"inline record {text!r}: {fast} against {full}")
+    return problems
+
+def check_equivalence(pages=300):
+    # Builds a generated book every way the tools offer and lists where the outputs disagree: the processed
+    # blocks against the generator's JSONL, the block file against the text, every text build option and
+    # the JSON build with and without workers and cache against the default build of each.
+    problems = check_inline()
+    with tempfile.TemporaryDirectory() as tmp:
+        metadata_path = os.path.join(tmp, "metadata.json")
+        with open(metadata_path, "w") as f:
+            json.dump({"title": "Check"}, f)
+        path = lambda name: os.path.join(tmp, name)
+        write_corpus(path("input.txt"), path("input_pre.json"), pages=pages)
+        number_pages(path("input.txt"), path("input_page.txt"))
+        process_file(path("input_page.txt"), path("input_pre.txt"))
+        with open(path("input_pre.json"), encoding="utf-8") as f:
+            expected = [tuple(json.loads(line).values()) for line in f]
+        processed = [(block.tag, block.text, block.page) for block in read_blocks(blocks_path(path("input_pre.txt")))]
+        if processed != expected:
+            problems.append(f"pre-processing: {sum(a != b for a, b in zip(processed, expected))} blocks differ from the "
+                            f"generated JSONL, {len(processed)} against {len(expected)} blocks")
+        problems.extend(compare_blocks(path("input_pre.txt")))
+
+        def build_text(name, **options):
+            create_epub_from_textfile(path("input_pre.txt"), metadata_path, path("cover.jpg"), output_path=path(name), validate=False, **options)
+            return name
+
+        def build_json(name, **options):
+            create_epub(path("input_pre.json"), path("cover.jpg"), metadata_path=metadata_path, output_path=path(name), validate=False, **options)
+            return name
+
+        builds = [
+            ("text", build_text("text.epub"), [
+                build_text("soup.epub", streaming=False),
+                build_text("nostream.epub", stream_output=False),
+                build_text("cold.epub", cache_dir=path("cache")),
+                build_text("warm.epub", cache_dir=path("cache")),
+            ]),
+            ("json", build_json("json.epub"), [
+                build_json("workers.epub", workers=2),
+                build_json("json_cold.epub", cache_dir=path("json_cache")),
+                build_json("json_warm.epub", workers=2, cache_dir=path("json_cache")),
+            ]),
+        ]
+        # Without the block file the text and its page index are read, and without the index the page markers.
+        os.remove(blocks_path(path("input_pre.txt")))
+        builds[0][2].append(build_text("lines.epub"))
+        os.remove(page_index_path(path("input_pre.txt")))
+        builds[0][2].append(build_text("markers.epub"))
+        for kind, reference, variants in builds:
+            for variant in variants:
+                for name in epub_differences(path(variant), path(reference)):
+                    problems.append(f"{variant}: {name} differs from the default {kind} build")
+    for problem in problems:
+        print(f"Mismatch: {problem}")
+    print(f"Equivalence checks on {pages} pages: {'failed' if problems else 'passed'}")
+    return problems
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time every stage on generated books of several sizes.")
+    parser.add_argument("--pages", type=int, nargs="+", default=[100, 300, 1000])
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the results")
+    parser.add_argument("--baseline", help="earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown or memory growth, 0.25 is 25%%")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest one counts")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced second run that measures peak memory")
+    parser.add_argument("--scaling", action="store_true", help="also run the large chapter and pre-processing scaling checks")
+    parser.add_argument("--check", action="store_true", help="only check that every build path gives the same output, on the first page count")
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(1 if check_equivalence(args.pages[0]) else 0)
+    regressions = []
+    if args.scaling:
+        regressions.extend(find_nonlinear(bench_large_chapter(), "paragraphs"))
+        regressions.extend(find_nonlinear(bench_pre_processing(), "blocks"))
+    results = bench_stages(args.pages, not args.no_memory, args.repeat)
+    with open(args.output, "w") as f:
+        json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions.extend(find_regressions(results, json.load(f), args.threshold))
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    if regressions:
+        sys.exit(1)
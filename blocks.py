@@ -0,0 +1,224 @@
+import os
+import re
+from array import array
+from page_numbering import page_re
+from temp_files import temp_path
+
+MAGIC = b"EPUBBLK1"
+
+class Block:
+    # One block of the book as it leaves pre-processing: its tag, page, text and line in the text output.
+    __slots__ = ("tag", "page", "text", "line")
+
+    def __init__(self, tag, page, text, line=0):
+        self.tag = tag
+        self.page = page
+        self.text = text
+        self.line = line
+
+    def __repr__(self):
+        return f"Block({self.tag!r}, {self.page!r}, {self.text[:30]!r}, {self.line!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, Block) and (self.tag, self.page, self.text, self.line) == (other.tag, other.page, other.text, other.line)
+
+ALLOWED_TAGS = ['h1', 'h2', 'h3', 'body', 'footer', 'blockquote']
+tag_pattern = re.compile(r"<(/?)({})(?:\s[^>]*)?>".format('|'.join(ALLOWED_TAGS)), re.IGNORECASE)
+
+def iter_fragments(lines):
+    # Cut the input into one fragment per top-level allowed element, yielded as (tag name, text)
+    # right after its closing tag is read, so only the element currently being read is held in memory.
+    buffer = []
+    open_tag = None
+    depth = 0
+    for line in lines:
+        pos = 0
+        for m in tag_pattern.finditer(line):
+            closing, name = m.group(1), m.group(2).lower()
+            if open_tag is None:
+                if not closing:
+                    open_tag = name
+                    depth = 1
+                    pos = m.start()
+            elif name == open_tag:
+                depth += -1 if closing else 1
+                if depth == 0:
+                    buffer.append(line[pos:m.end()])
+                    yield open_tag, ''.join(buffer)
+                    buffer = []
+                    open_tag = None
+        if open_tag is not None:
+            buffer.append(line[pos:])
+    if buffer:
+        yield open_tag, ''.join(buffer)
+
+def blocks_path(text_path):
+    return text_path + ".blocks"
+
+def is_fresh(path, source_path):
+    # A binary file is only used while it is at least as new as the text it was made from.
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source_path)
+
+def fits_block_file(blocks):
+    # Pages are stored as 64-bit whole numbers, with -1 for blocks without a page.
+    return all(block.page is None or (type(block.page) is int and 0 <= block.page < 2 ** 63) for block in blocks)
+
+def collect_blocks(lines, writer):
+    # Passes pre-processed lines through while handing writer a Block for every fragment the EPUB builder
+    # would read from the text, found with the same iter_fragments. The page marker after a block gives the
+    # page of every block read since the previous marker. A fragment that a Block cannot give back as it
+    # was, with attributes on its tag or never closed, rejects the writer, so the builder reads the text.
+    waiting = []
+    passed = []
+    line_num = 0
+
+    def read_lines():
+        nonlocal waiting, line_num
+        for line in lines:
+            line_num += 1
+            m = page_re.fullmatch(line.rstrip("\n"))
+            if m:
+                page = int(m.group(1))
+                for block in waiting:
+                    block.page = page
+                    writer.add(block)
+                waiting = []
+            passed.append(line)
+            yield line
+
+    for name, fragment in iter_fragments(read_lines()):
+        opening, closing = f"<{name}>", f"</{name}>"
+        if fragment.startswith(opening) and fragment.endswith(closing):
+            waiting.append(Block(name, None, fragment[len(opening):-len(closing)], line_num - fragment.count("\n")))
+        else:
+            writer.reject(f"line {line_num}: {fragment[:40]!r} does not fit the block format")
+        yield from passed
+        passed.clear()
+    yield from passed
+    for block in waiting:
+        writer.add(block)
+
+def compare_blocks(text_path):
+    # Differences between the block file of text_path and the blocks read from the text itself.
+    class Collector:
+        def __init__(self):
+            self.blocks = []
+            self.rejected = None
+        def add(self, block):
+            self.blocks.append(block)
+        def reject(self, reason):
+            self.rejected = reason
+    collector = Collector()
+    with open(text_path, "r", encoding="utf-8") as f:
+        for _ in collect_blocks(f, collector):
+            pass
+    if collector.rejected:
+        return [f"text does not fit the block format: {collector.rejected}"]
+    stored = read_blocks(blocks_path(text_path))
+    problems = [f"block {i}: {a!r} in the block file, {b!r} in the text"
+                for i, (a, b) in enumerate(zip(stored, collector.blocks)) if a != b]
+    if len(stored) != len(collector.blocks):
+        problems.append(f"{len(stored)} blocks in the block file, {len(collector.blocks)} in the text")
+    return problems
+
+class BlockWriter:
+    # Streams blocks into the binary block format: first the texts as they come, then columns of tag
+    # numbers, pages, lines and text end offsets, and last the sizes of the parts. Only the columns are
+    # kept in memory while writing, and loading only copies arrays and decodes the text once.
+    # Blocks without a page get page -1.
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = temp_path(path)
+        self.file = open(self.temp_path, "wb")
+        self.file.write(MAGIC)
+        self.tags = []
+        self.tag_numbers = {}
+        self.tag_column = array("B")
+        self.pages = array("q")
+        self.lines = array("q")
+        self.ends = array("q")
+        self.end = 0
+        self.text_size = 0
+        self.rejected = None
+
+    def reject(self, reason):
+        # The blocks do not match the text; close() then writes no file at all.
+        self.rejected = reason
+
+    def add(self, block):
+        if block.tag not in self.tag_numbers:
+            self.tag_numbers[block.tag] = len(self.tags)
+            self.tags.append(block.tag)
+        # The page goes first, since a page that is not a whole number is the likely failure.
+        self.pages.append(-1 if block.page is None else block.page)
+        self.tag_column.append(self.tag_numbers[block.tag])
+        self.lines.append(block.line)
+        self.end += len(block.text)
+        self.ends.append(self.end)
+        data = block.text.encode("utf-8")
+        self.file.write(data)
+        self.text_size += len(data)
+
+    def close(self):
+        if self.rejected:
+            print(f"Not writing {self.path}: {self.rejected}")
+            self.abort()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        tag_table = "\n".join(self.tags).encode("utf-8")
+        self.file.write(tag_table)
+        for column in (self.tag_column, self.pages, self.lines, self.ends):
+            column.tofile(self.file)
+        array("q", [len(self.ends), len(tag_table), self.text_size]).tofile(self.file)
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.temp_path)
+
+def write_blocks(path, blocks):
+    writer = BlockWriter(path)
+    try:
+        for block in blocks:
+            writer.add(block)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+
+def read_blocks(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a block file")
+        sizes = array("q")
+        f.seek(-sizes.itemsize * 3, os.SEEK_END)
+        sizes.fromfile(f, 3)
+        count, tag_size, text_size = sizes
+        f.seek(len(MAGIC))
+        text = f.read(text_size).decode("utf-8")
+        tags = f.read(tag_size).decode("utf-8").split("\n")
+        columns = []
+        for typecode in "Bqqq":
+            column = array(typecode)
+            column.fromfile(f, count)
+            columns.append(column)
+    tag_column, pages, lines, ends = columns
+    blocks = []
+    start = 0
+    for tag, page, line, end in zip(tag_column, pages, lines, ends):
+        blocks.append(Block(tags[tag], None if page < 0 else page, text[start:end], line))
+        start = end
+    return blocks
+
+if __name__ == "__main__":
+    import sys
+    failed = False
+    for path in sys.argv[1:] or ["input_pre.txt"]:
+        problems = compare_blocks(path)
+        for problem in problems[:20]:
+            print(f"{path}: {problem}")
+        print(f"{'MISMATCH' if problems else 'OK'} {blocks_path(path)}")
+        failed = failed or bool(problems)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+from temp_files import replacing
+
+CACHE_DIR = ".epub_cache"
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+class ChapterCache:
+    # Rendered chapters stored on disk as one JSON file each, named by a hash of everything the chapter
+    # depends on. Entries are touched when used, and the least recently used ones are removed on close
+    # once the cache grows beyond max_bytes.
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, *parts):
+        # Builders pass their BUILDER_VERSION among the parts and raise it whenever their chapter output
+        # changes, so entries rendered by older code are never used.
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(str(part).encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        try:
+            # Another build may have evicted the entry since; it was read already, so it is still a hit.
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        with replacing(self.path(key), encoding="utf-8") as f:
+            json.dump(entry, f)
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def close(self):
+        removed = self.evict()
+        note = f", {removed} evicted" if removed else ""
+        print(f"Chapter cache: {self.hits} hits, {self.misses} misses{note}")
+
+class MemoryChapterCache(ChapterCache):
+    # Same interface, with the entries kept in a dict for a long-running process. Closing drops every
+    # entry the build did not use and resets the counters for the next build.
+    def __init__(self):
+        self.entries = {}
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.used.add(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.used.add(key)
+
+    def evict(self):
+        stale = self.entries.keys() - self.used
+        for key in stale:
+            del self.entries[key]
+        self.used = set()
+        return len(stale)
+
+    def close(self):
+        super().close()
+        self.hits = 0
+        self.misses = 0
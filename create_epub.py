@@ -1,27 +1,125 @@
 import json
 from ebooklib import epub
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
 import os
+from epub_writer import COMPRESS_LEVEL, StreamingEpubWriter, write_epub
+from chapter_cache import CACHE_DIR, ChapterCache
+from page_numbering import index_lines, load_page_index, page_index_path, page_re
+from blocks import ALLOWED_TAGS, blocks_path, is_fresh, iter_fragments, read_blocks
+from tracing import span
+from validate_epub import require_valid_epub
 
-def create_epub_from_textfile(input_path, metadata_path, cover_path='cover.jpg'):
+BUILDER_VERSION = 2
+# Chapters that grow beyond this many characters continue in another file, which e-readers open much faster.
+MAX_CHAPTER_BYTES = 256 * 1024
+SPLIT_TAGS = {'h2', 'h3', 'body', 'blockquote'}
+
+def parse_fragment(fragment):
+    return BeautifulSoup(fragment, "html.parser").find_all(ALLOWED_TAGS)
+
+def group_chapters(fragments):
+    # Groups (name, text, block) fragments so that each group starts at an h1. Anything before the first
+    # h1 stays with the first chapter, since its footers end up in that chapter's footnotes.
+    group = []
+    seen_h1 = False
+    for fragment in fragments:
+        if fragment[0] == 'h1':
+            if seen_h1:
+                yield group
+                group = []
+            seen_h1 = True
+        group.append(fragment)
+    if group:
+        yield group
+
+def iter_elements_soup(lines):
+    # Previous whole-document parse, kept as a fallback for comparison. Yields every element with the number
+    # of page markers before it, which is the block number the streaming parse gives it.
+    soup = BeautifulSoup(''.join(lines), "html.parser")
+    block = 0
+    for node in soup.descendants:
+        if isinstance(node, Tag):
+            if node.name in ALLOWED_TAGS:
+                yield node, block
+        else:
+            block += sum(1 for line in node.split("\n") if page_re.fullmatch(line))
+
+def page_ends(blocks):
+    # Indices of the blocks followed by a page marker in the text, the last block of each page.
+    return [i for i, block in enumerate(blocks)
+            if block.page is not None and (i + 1 == len(blocks) or blocks[i + 1].page != block.page)]
+
+def block_lines(blocks):
+    # The text of blocks as pre-processing writes it, with the page markers.
+    ends = set(page_ends(blocks))
+    for i, block in enumerate(blocks):
+        yield f"<{block.tag}>{block.text}</{block.tag}>\n"
+        if i in ends:
+            yield f"<{block.page}>\n"
+
+def page_break(page):
+    return f'<span epub:type="pagebreak" id="page_{page}" role="doc-pagebreak" aria-label="{page}"></span>'
+
+def part_number(chapter):
+    # 0 for the first file of a chapter, 1 for chap_n_2.xhtml and so on.
+    name = chapter.file_name[:-len(".xhtml")].split("_")
+    return int(name[2]) - 1 if len(name) > 2 else 0
+
+def h3_link(href, title):
+    # The uid becomes the NCX navPoint id, so it includes the file name to stay unique in the book.
+    return epub.Link(href, title, href.replace(".xhtml#", "_"))
+
+def count_page_markers(lines, counter):
+    # Elements are yielded right after their last line is read, so the count is the number of the block they belong to.
+    for line in lines:
+        if page_re.fullmatch(line.rstrip("\n")):
+            counter[0] += 1
+        yield line
+
+def create_epub_from_textfile(input_path, metadata_path, cover_path='cover.jpg', streaming=True, stream_output=True, cache_dir=None, cache=None, output_path=None, max_chapter_bytes=MAX_CHAPTER_BYTES, compress_level=COMPRESS_LEVEL, validate=True, document=None):
+    # The blocks written by pre-processing already carry their pages, so they are used instead of the text
+    # and its page index until the text is edited.
+    with span("create_epub", input=input_path):
+        options = dict(cover_path=cover_path, streaming=streaming, stream_output=stream_output, cache_dir=cache_dir, cache=cache, output_path=output_path,
+                       max_chapter_bytes=max_chapter_bytes, compress_level=compress_level, validate=validate, document=document)
+        if is_fresh(blocks_path(input_path), input_path):
+            return create_epub_from_lines((), metadata_path, blocks=read_blocks(blocks_path(input_path)), **options)
+        index_path = page_index_path(input_path)
+        if is_fresh(index_path, input_path):
+            page_index = load_page_index(index_path)
+        else:
+            # An index older than the text would put the pages on the wrong blocks, so the pages are taken
+            # from the markers in the text instead.
+            page_index = []
+            with open(input_path, "r") as file:
+                for _ in index_lines(file, page_index):
+                    pass
+        with open(input_path, "r") as file:
+            return create_epub_from_lines(file, metadata_path, page_index=page_index, **options)
+
+def create_epub_from_lines(lines, metadata_path, cover_path='cover.jpg', streaming=True, stream_output=True, page_index=None, cache_dir=None, cache=None, output_path=None, max_chapter_bytes=MAX_CHAPTER_BYTES, compress_level=COMPRESS_LEVEL, blocks=None, validate=True, document=None):
+    # With blocks from the binary block format, lines is not read. A document given is filled with the
+    # chapters and table of contents, for rendering other targets from the same parse.
     with open(metadata_path, "r") as meta_file:
         metadata = json.load(meta_file)
     title = metadata.get("title", "Untitled Book")
     author = metadata.get("author", "Unknown Author")
     identifier = metadata.get("identifier", "0012345678900")
     language = metadata.get("language", "en")
-    output_path = f"{title}.epub"
+    output_path = output_path or f"{title}.epub"
     book = epub.EpubBook()
     book.set_identifier(identifier)
     book.set_title(title)
     book.set_language(language)
     book.add_author(author)
-    
-    css = epub.EpubItem(
-        uid="style_base",
-        file_name="style/base.css",
-        media_type="text/css",
-        content='''
+    options = {"compresslevel": compress_level}
+    writer = StreamingEpubWriter(output_path, book, options) if stream_output else None
+    try:
+        css = epub.EpubItem(
+            uid="style_base",
+            file_name="style/base.css",
+            media_type="text/css",
+            content='''
             body { 
                 font-family: serif;
                 line-height: 1.3;
@@ -39,110 +137,272 @@ def create_epub_from_textfile(input_path, metadata_path, cover_path='cover.jpg')
             }
             .footnote { font-size: 0.85em; color: #666; }
         '''
-    )
-    book.add_item(css)
-    
-    if os.path.exists(cover_path):
-        with open(cover_path, "rb") as cover_file:
-            book.set_cover("cover.jpg", cover_file.read())
-    
-    # Parse input content
-    with open(input_path, "r") as file:
-        soup = BeautifulSoup(file.read(), "html.parser")
-    
-    chapters = []
-    toc_structure = []
-    current_chapter = None
-    current_h2 = None
-    footnote_entries = []
-
-    def create_chapter(title):
-        chapter = epub.EpubHtml(
-            title=title[:50],
-            file_name=f"chap_{len(chapters)+1}.xhtml",
-            lang=language
         )
-        chapter.add_item(css)
-        chapter.content = '<body>'
-        return chapter
+        book.add_item(css)
+        if document is not None:
+            document.set_metadata(title, author, language, css.content)
+
+        if os.path.exists(cover_path):
+            with open(cover_path, "rb") as cover_file:
+                book.set_cover("cover.jpg", cover_file.read())
+
+        chapters = []
+        toc_structure = []
+        # The chapter started by the last h1, and the file its text currently goes to, which is a continuation
+        # file once the chapter got too long.
+        current_chapter = None
+        current_file = None
+        current_h2 = None
+        chapter_parts = []
+        part_size = 0
+        last_page = None
+        footnote_entries = []
+        # With a page index, the page of every block is known before its marker is read.
+        block_pages = [page for _, page in page_index] if page_index else []
+        block_count = [0]
+        if blocks is not None and streaming:
+            block_pages = [block.page for block in blocks]
+            fragments = ((block.tag, f"<{block.tag}>{block.text}</{block.tag}>", i) for i, block in enumerate(blocks))
+        else:
+            if blocks is not None:
+                block_pages = [blocks[i].page for i in page_ends(blocks)]
+                lines = block_lines(blocks)
+            if block_pages:
+                lines = count_page_markers(lines, block_count)
+            fragments = ((name, text, block_count[0]) for name, text in iter_fragments(lines))
+        anchored_pages = set()
+        if cache is None and cache_dir:
+            cache = ChapterCache(cache_dir)
+        group_records = []
+
+        def create_chapter(title, part=0):
+            # Continuation files of chapter n are named chap_n_2.xhtml, chap_n_3.xhtml and so on.
+            number = len(toc_structure) if part else len(toc_structure) + 1
+            chapter = epub.EpubHtml(
+                title=title[:50],
+                file_name=f"chap_{number}_{part + 1}.xhtml" if part else f"chap_{number}.xhtml",
+                lang=language
+            )
+            chapter.add_item(css)
+            return chapter
+
+        def add_chapter(chapter, xhtml=None, pages=None):
+            content = chapter.content
+            chapters.append(chapter)
+            if document is not None:
+                document.add_file(chapter.title, chapter.file_name, content)
+            book.add_item(chapter)
+            if writer:
+                if xhtml is None:
+                    xhtml, pages = writer.write_item(chapter)
+                    xhtml = xhtml.decode("utf-8")
+                else:
+                    writer.write_rendered(chapter, xhtml, pages)
+            if cache:
+                record = {"title": chapter.title, "content": content, "part": part_number(chapter)}
+                if writer:
+                    record["xhtml"] = xhtml
+                    record["pages"] = pages
+                group_records.append(record)
 
-    def finalize_chapter():
-        nonlocal current_chapter, footnote_entries
-        if current_chapter:
+        def emit(text):
+            nonlocal part_size
+            chapter_parts.append(text)
+            part_size += len(text)
+
+        def finish_file():
+            # Footnotes read so far go to the end of the file they were read in.
+            nonlocal current_file, footnote_entries, part_size
             if footnote_entries:
-                current_chapter.content += '<div class="footnotes">'
-                current_chapter.content += ''.join(footnote_entries)
-                current_chapter.content += '</div>'
+                chapter_parts.append('<div class="footnotes">')
+                chapter_parts.extend(footnote_entries)
+                chapter_parts.append('</div>')
                 footnote_entries = []
-            current_chapter.content += '</body>'
-            chapters.append(current_chapter)
-            book.add_item(current_chapter)
-    
-    # Only process allowed content types: h1, h2, h3, body, footer, blockquote.
-    for element in soup.find_all(['h1', 'h2', 'h3', 'body', 'footer', 'blockquote']):
-        if element.name == 'h1':
-            finalize_chapter()
-            current_chapter = create_chapter(element.get_text())
-            toc_structure.append((current_chapter, []))
-            current_chapter.content += " " + str(element)
-        elif element.name == 'h2' and current_chapter:
-            h2_id = f"sec_{len(toc_structure[-1][1])}"
-            element['id'] = h2_id
-            current_h2 = (
-                epub.Section(element.get_text(), f"{current_chapter.file_name}#{h2_id}"),
-                []
-            )
-            toc_structure[-1][1].append(current_h2)
-            current_chapter.content += " " + str(element)
-        elif element.name == 'h3' and current_chapter:
-            if not toc_structure[-1][1]:
-                # Create a dummy H2 if missing.
-                h2_id = "sec_0"
-                dummy_h2 = epub.Section("Section", f"{current_chapter.file_name}#{h2_id}")
-                current_h2 = (dummy_h2, [])
-                toc_structure[-1][1].append(current_h2)
-            h3_id = f"subsec_{len(current_h2[1])}"
-            element['id'] = h3_id
-            current_h2[1].append(
-                epub.Link(
-                    f"{current_chapter.file_name}#{h3_id}",
-                    element.get_text(),
-                    f"subsec_{len(current_h2[1])}"
+            chapter_parts.append('</body>')
+            # Fragments are collected per file and joined once, repeated += would copy the whole chapter each time.
+            current_file.content = ''.join(chapter_parts)
+            chapter_parts.clear()
+            part_size = 0
+            add_chapter(current_file)
+            current_file = None
+
+        def finalize_chapter():
+            nonlocal current_chapter
+            if current_chapter:
+                finish_file()
+                current_chapter = None
+
+        def split_chapter():
+            nonlocal current_file
+            part = part_number(current_file) + 1
+            finish_file()
+            current_file = create_chapter(current_chapter.title, part)
+            emit('<body>')
+
+        def mark_page(block):
+            if block < len(block_pages) and block_pages[block] is not None:
+                page = block_pages[block]
+                if page not in anchored_pages:
+                    anchored_pages.add(page)
+                    emit(page_break(page))
+
+        def add_element(element, block):
+            nonlocal current_chapter, current_file, current_h2, last_page, part_size
+            page = block_pages[block] if block < len(block_pages) else None
+            if current_chapter and element.name in SPLIT_TAGS and max_chapter_bytes and part_size >= max_chapter_bytes:
+                # With page numbers, a long chapter is only split where a new page starts, so the footnotes
+                # at the bottom of a page stay in the same file as its text.
+                if page is None or page != last_page:
+                    split_chapter()
+            if element.name != 'footer':
+                last_page = page
+            if current_chapter and element.name != 'h1':
+                mark_page(block)
+            if element.name == 'h1':
+                finalize_chapter()
+                current_chapter = current_file = create_chapter(element.get_text())
+                emit('<body>')
+                toc_structure.append((current_chapter, []))
+                mark_page(block)
+                emit(" " + str(element))
+            elif element.name == 'h2' and current_chapter:
+                h2_id = f"sec_{len(toc_structure[-1][1])}"
+                element['id'] = h2_id
+                current_h2 = (
+                    epub.Section(element.get_text(), f"{current_file.file_name}#{h2_id}"),
+                    []
                 )
-            )
-            current_chapter.content += " " + str(element)
-        elif element.name == 'footer':
-            footnote_entries.append(f'<div class="footnote">{element.get_text()}</div>')
-        elif element.name == 'blockquote' and current_chapter:
-            current_chapter.content += " " + f'<blockquote>{element.get_text()}</blockquote>'
-        elif element.name == 'body' and current_chapter:
-            # If your input includes a <body> tag, append it as needed.
-            current_chapter.content += " " + str(element)
-    
-    finalize_chapter()
-
-    # Build hierarchical TOC
-    book.toc = tuple(
-        (
-            epub.Section(chap.title, chap.file_name),
-            [
+                toc_structure[-1][1].append(current_h2)
+                emit(" " + str(element))
+            elif element.name == 'h3' and current_chapter:
+                if not toc_structure[-1][1]:
+                    # Create a dummy H2 if missing, pointing at the file of its first subsection.
+                    current_h2 = (epub.Section("Section", current_file.file_name), [])
+                    toc_structure[-1][1].append(current_h2)
+                # Numbered per chapter, so subsections under different h2s get different ids.
+                h3_id = f"subsec_{len(toc_structure[-1][1]) - 1}_{len(current_h2[1])}"
+                element['id'] = h3_id
+                current_h2[1].append(h3_link(f"{current_file.file_name}#{h3_id}", element.get_text()))
+                emit(" " + str(element))
+            elif element.name == 'footer':
+                footnote_entries.append(f'<div class="footnote">{element.get_text()}</div>')
+                part_size += len(footnote_entries[-1])
+            elif element.name == 'blockquote' and current_chapter:
+                emit(" " + f'<blockquote>{element.get_text()}</blockquote>')
+            elif element.name == 'body' and current_chapter:
+                # If your input includes a <body> tag, append it as needed.
+                emit(" " + str(element))
+
+        def toc_record(chapter, entries):
+            # Section and link targets relative to the chapter's file name, which depends on the chapter's
+            # position in the book, and may point into one of its continuation files.
+            base = chapter.file_name[:-len(".xhtml")]
+            return [[h2.title, h2.href[len(base):], [[h3.title, h3.href[len(base):]] for h3 in h3_links]]
+                    for h2, h3_links in entries]
+
+        def replay_group(entry):
+            # Adds the chapters of a cached group as if its elements had been read again.
+            for record in entry["chapters"]:
+                chapter = create_chapter(record["title"], record["part"])
+                chapter.content = record["content"]
+                if not record["part"]:
+                    base = chapter.file_name[:-len(".xhtml")]
+                    toc_structure.append((chapter, [
+                        (epub.Section(h2_title, base + h2_href),
+                         [h3_link(base + h3_href, h3_title) for h3_title, h3_href in h3_links])
+                        for h2_title, h2_href, h3_links in record["toc"]
+                    ]))
+                add_chapter(chapter, record.get("xhtml"), record.get("pages"))
+            anchored_pages.update(entry["anchored"])
+
+        if streaming and cache:
+            # Chapters are built one group of fragments at a time. A group only depends on its own text, the pages
+            # of its blocks and which of those pages were already anchored, so it is only parsed when one of those
+            # changed.
+            for group in group_chapters(fragments):
+                with span("chapter_group", fragments=len(group)) as info:
+                    group_pages = {block_pages[block] for _, _, block in group if block < len(block_pages)}
+                    key = cache.key("txt", BUILDER_VERSION, css.content, language, max_chapter_bytes,
+                                    [(text, block_pages[block] if block < len(block_pages) else None) for _, text, block in group],
+                                    sorted(group_pages & anchored_pages))
+                    entry = cache.get(key)
+                    info["cached"] = bool(entry)
+                    if entry:
+                        replay_group(entry)
+                        continue
+                    toc_start = len(toc_structure)
+                    anchored_before = set(anchored_pages)
+                    group_records.clear()
+                    with span("parse") as parse_info:
+                        elements = 0
+                        for _, text, block in group:
+                            for element in parse_fragment(text):
+                                add_element(element, block)
+                                elements += 1
+                        parse_info["elements"] = elements
+                    with span("finalize_chapter"):
+                        finalize_chapter()
+                    first_parts = (record for record in group_records if not record["part"])
+                    for record, (chapter, entries) in zip(first_parts, toc_structure[toc_start:]):
+                        record["toc"] = toc_record(chapter, entries)
+                    cache.put(key, {"chapters": list(group_records), "anchored": sorted(anchored_pages - anchored_before)})
+            cache.close()
+        elif streaming:
+            # Without a cache each fragment is parsed as soon as it is read, so memory stays flat however long
+            # a chapter gets.
+            with span("parse") as parse_info:
+                elements = 0
+                for _, text, block in fragments:
+                    for element in parse_fragment(text):
+                        add_element(element, block)
+                        elements += 1
+                finalize_chapter()
+                parse_info["elements"] = elements
+        else:
+            # Only process allowed content types: h1, h2, h3, body, footer, blockquote.
+            with span("parse_document"):
+                for element, block in iter_elements_soup(lines):
+                    add_element(element, block)
+                finalize_chapter()
+
+        # Build hierarchical TOC
+        with span("toc", chapters=len(chapters)):
+            book.toc = tuple(
                 (
-                    h2_section,
-                    h3_links
-                ) for h2_section, h3_links in h2_entries
-            ]
-        ) for chap, h2_entries in toc_structure
-    )
-    
-    book.add_item(epub.EpubNcx())
-    nav = epub.EpubNav()
-    nav.add_item(css)
-    book.add_item(nav)
-    book.spine = ['nav'] + chapters
-    
-    # Generate EPUB
-    epub.write_epub(output_path, book, {})
+                    epub.Section(chap.title, chap.file_name),
+                    [
+                        (
+                            h2_section,
+                            h3_links
+                        ) for h2_section, h3_links in h2_entries
+                    ]
+                ) for chap, h2_entries in toc_structure
+            )
+            if document is not None:
+                document.set_toc(book.toc)
+
+        book.add_item(epub.EpubNcx())
+        nav = epub.EpubNav()
+        nav.add_item(css)
+        book.add_item(nav)
+        book.spine = ['nav'] + chapters
+
+        # Generate EPUB
+        with span("write_epub", streaming=bool(writer)):
+            if writer:
+                writer.close()
+            else:
+                write_epub(output_path, book, options)
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
     print(f"Created EPUB: {output_path}")
+    if validate:
+        with span("validate_epub"):
+            require_valid_epub(output_path)
+    return output_path
 
-create_epub_from_textfile('input_pre.txt', 'metadata.json', 'cover.jpg')
+if __name__ == "__main__":
+    create_epub_from_textfile('input_pre.txt', 'metadata.json', 'cover.jpg', cache_dir=CACHE_DIR)
 
@@ -1,10 +1,239 @@
 import os
+import re
 import json
+from concurrent.futures import ProcessPoolExecutor
 from ebooklib import epub
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, NavigableString
+from epub_writer import COMPRESS_LEVEL, StreamingEpubWriter, write_epub
+from chapter_cache import CACHE_DIR, ChapterCache
+from tracing import span
+from validate_epub import require_valid_epub
+from blocks import Block, blocks_path, fits_block_file, is_fresh, read_blocks, write_blocks
 
-def create_epub(input_path, cover_path='cover.jpg'):
-    with open("metadata.json", "r", encoding="utf-8") as meta_file:
+BUILDER_VERSION = 3
+# Chapters with more text than this continue in another file, which e-readers open much faster.
+MAX_CHAPTER_BYTES = 256 * 1024
+INLINE_TAGS = {'sup', 'sub', 'i', 'b', 'em', 'strong'}
+CHUNK_MIN_BYTES = 1 << 20
+inline_tag_pattern = re.compile(r"<(/?)([a-z]+)>")
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+def text_node(segment):
+    # Same whitespace collapsing as the html.parser tree builder applies to whitespace-only strings.
+    if not segment.strip(ASCII_SPACES):
+        segment = '\n' if '\n' in segment else ' '
+    return NavigableString(segment)
+
+def parse_inline(soup, text):
+    # Most records are plain text or only use a few bare inline tags, so build those nodes directly
+    # and only hand records with any other markup or entities to the full parser.
+    if '&' in text:
+        return [BeautifulSoup(text, 'html.parser')]
+    if '<' not in text:
+        return [text_node(text)] if text else []
+    nodes = []
+    stack = []
+
+    def add(node):
+        if stack:
+            stack[-1].append(node)
+        else:
+            nodes.append(node)
+
+    pos = 0
+    for m in inline_tag_pattern.finditer(text):
+        closing, name = m.group(1), m.group(2)
+        segment = text[pos:m.start()]
+        if name not in INLINE_TAGS or '<' in segment:
+            return [BeautifulSoup(text, 'html.parser')]
+        if segment:
+            add(text_node(segment))
+        if closing:
+            if not stack or stack[-1].name != name:
+                return [BeautifulSoup(text, 'html.parser')]
+            stack.pop()
+        else:
+            tag = soup.new_tag(name)
+            add(tag)
+            stack.append(tag)
+        pos = m.end()
+    segment = text[pos:]
+    if stack or '<' in segment:
+        return [BeautifulSoup(text, 'html.parser')]
+    if segment:
+        nodes.append(text_node(segment))
+    return nodes
+
+def decode_lines(lines):
+    # Returns the blocks with their line numbers counted from the start of lines, the number of malformed
+    # lines and the number of lines read.
+    records = []
+    skipped = 0
+    line_num = 0
+    for line_num, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            entry = json.loads(line)
+            records.append(Block(entry.get("label", "").lower(), entry.get("page", 0), entry.get("text", ""), line_num))
+        except (json.JSONDecodeError, AttributeError):
+            skipped += 1
+    return records, skipped, line_num
+
+def decode_range(byte_range):
+    input_path, start, end = byte_range
+    with open(input_path, "rb") as file:
+        file.seek(start)
+        data = file.read(end - start)
+    lines = data.decode("utf-8").split("\n")
+    if not lines[-1]:
+        lines.pop()
+    return decode_lines(lines)
+
+def split_byte_ranges(input_path, count):
+    # Cut the file into roughly equal ranges that each start right after a newline.
+    size = os.path.getsize(input_path)
+    bounds = [0]
+    with open(input_path, "rb") as file:
+        for i in range(1, count):
+            file.seek(size * i // count)
+            file.readline()
+            position = file.tell()
+            if bounds[-1] < position < size:
+                bounds.append(position)
+    bounds.append(size)
+    return [(input_path, start, end) for start, end in zip(bounds, bounds[1:])]
+
+def read_records(input_path, executor=None, workers=1, keep_blocks=False):
+    # Records come back in file order as Blocks. Malformed lines are counted and reported. With keep_blocks,
+    # the blocks are also saved in the binary block format next to the input. Builds load a block file
+    # instead of decoding the JSON again, until the input changes.
+    cache_path = blocks_path(input_path)
+    if is_fresh(cache_path, input_path):
+        return read_blocks(cache_path)
+    if executor and os.path.getsize(input_path) > CHUNK_MIN_BYTES:
+        chunks = executor.map(decode_range, split_byte_ranges(input_path, workers * 4))
+    else:
+        with open(input_path, "r", encoding="utf-8") as file:
+            chunks = [decode_lines(file)]
+    blocks = []
+    skipped = 0
+    first_line = 0
+    for records, chunk_skipped, line_count in chunks:
+        for block in records:
+            block.line += first_line
+        blocks.extend(records)
+        skipped += chunk_skipped
+        first_line += line_count
+    if skipped:
+        print(f"Skipped {skipped} malformed lines in {input_path}")
+    if keep_blocks:
+        if not fits_block_file(blocks):
+            print(f"Not writing {cache_path}: pages must be whole numbers")
+        else:
+            try:
+                write_blocks(cache_path, blocks)
+            except OSError as e:
+                print(f"Could not write {cache_path}: {e}")
+    return blocks
+
+def split_chapters(records):
+    # Cheap first pass that only finds the h1 boundaries. Consecutive h1 records on the same page
+    # form one heading; any other record in between ends that heading. The first record placed on
+    # each page also carries that page, so a page-break anchor can be put in front of it.
+    chapters = []
+    current_chapter = None
+    header_open = False
+    header_page = None
+    anchored_pages = set()
+
+    def anchor(page):
+        if page in anchored_pages:
+            return None
+        anchored_pages.add(page)
+        return page
+
+    for block in records:
+        label, text, page = block.tag, block.text, block.page
+        if label == 'h1':
+            if header_open and header_page == page:
+                current_chapter["title"] += " " + text
+                current_chapter["merged"] = True
+            else:
+                current_chapter = {"title": text, "merged": False, "page": anchor(page), "records": []}
+                chapters.append(current_chapter)
+                header_open = True
+                header_page = page
+        else:
+            if label in ('body', 'blockquote', 'footer') and current_chapter:
+                current_chapter["records"].append((label, text, anchor(page)))
+            header_open = False
+    return chapters
+
+def split_parts(chapters, max_bytes):
+    # Long chapters continue in further files, numbered by "part". A new file only starts where a new page
+    # starts, so the footnotes at the bottom of a page stay in the same file as its text.
+    parts = []
+    for chapter in chapters:
+        records = chapter["records"]
+        current = dict(chapter, part=0, records=[])
+        parts.append(current)
+        size = len(chapter["title"])
+        for record in records:
+            if max_bytes and size >= max_bytes and record[2] is not None:
+                current = dict(chapter, page=None, part=current["part"] + 1, records=[])
+                parts.append(current)
+                size = 0
+            current["records"].append(record)
+            size += len(record[1])
+    return parts
+
+def page_break(soup, page):
+    return soup.new_tag('span', attrs={"epub:type": "pagebreak", "id": f"page_{page}", "role": "doc-pagebreak", "aria-label": str(page)})
+
+def render_chapter(source):
+    soup = BeautifulSoup('<html><head></head><body></body></html>', 'html.parser')
+    # Add title
+    title_tag = soup.new_tag('title')
+    title_tag.string = source["title"][:50] if source["merged"] else source["title"]
+    soup.head.append(title_tag)
+    # Link CSS
+    link_tag = soup.new_tag('link', rel='stylesheet', href='style/base.css', type='text/css')
+    soup.head.append(link_tag)
+    body = soup.body
+    if source["page"] is not None:
+        body.append(page_break(soup, source["page"]))
+    if not source["part"]:
+        header_tag = soup.new_tag('h1')
+        header_tag.string = source["title"]
+        body.append(header_tag)
+    footers = []
+    for label, text, page in source["records"]:
+        if page is not None:
+            body.append(page_break(soup, page))
+        if label == 'body':
+            p_tag = soup.new_tag('p')
+            p_tag.extend(parse_inline(soup, text))
+            body.append(p_tag)
+        elif label == 'blockquote':
+            blockquote_tag = soup.new_tag('blockquote')
+            blockquote_tag.extend(parse_inline(soup, text))
+            body.append(blockquote_tag)
+        elif label == 'footer':
+            footers.append(parse_inline(soup, text))
+    if footers:
+        footnotes_div = soup.new_tag('div', **{"class": "footnotes"})
+        for footer in footers:
+            footnote_div = soup.new_tag('div', **{"class": "footnote"})
+            footnote_div.extend(footer)
+            footnotes_div.append(footnote_div)
+        body.append(footnotes_div)
+    return str(soup)
+
+def create_epub(input_path, cover_path='cover.jpg', stream_output=True, workers=1, cache_dir=None, metadata_path='metadata.json', output_path=None, max_chapter_bytes=MAX_CHAPTER_BYTES, compress_level=COMPRESS_LEVEL, validate=True, document=None, keep_blocks=False):
+    # A document given is filled with the chapters and table of contents, for rendering other targets.
+    with open(metadata_path, "r", encoding="utf-8") as meta_file:
         metadata = json.load(meta_file)
 
     title = metadata.get("title", "Untitled Book")
@@ -29,119 +258,89 @@ blockquote { margin: 0 0 0 1em !important; padding-left: 0.5em; border-left: 1px
     book.set_title(title)
     book.set_language(language)
     book.add_author(author)
+    output_path = output_path or f"{title}.epub"
+    options = {"compresslevel": compress_level}
+    writer = StreamingEpubWriter(output_path, book, options) if stream_output else None
+    try:
+        # Add CSS
+        css = epub.EpubItem(uid="style_base", file_name="style/base.css", media_type="text/css", content=css_content)
+        book.add_item(css)
+        if document is not None:
+            document.set_metadata(title, author, language, css_content)
 
-    # Add CSS
-    css = epub.EpubItem(uid="style_base", file_name="style/base.css", media_type="text/css", content=css_content)
-    book.add_item(css)
-
-    if os.path.exists(cover_path):
-        with open(cover_path, "rb") as cover_file:
-            book.set_cover("cover.jpg", cover_file.read())
+        if os.path.exists(cover_path):
+            with open(cover_path, "rb") as cover_file:
+                book.set_cover("cover.jpg", cover_file.read())
 
-    chapters = []
-    toc_structure = []
-    current_chapter = None
-    current_footers = []
-    current_header_text = None
-    current_header_page = None
-    current_header_tag = None
-
-    def create_chapter(chapter_title):
-        chapter = epub.EpubHtml(title=chapter_title[:50], file_name=f"chap_{len(chapters)+1}.xhtml", lang=language)
-        soup = BeautifulSoup('<html><head></head><body></body></html>', 'html.parser')
-        
-        # Add title
-        title_tag = soup.new_tag('title')
-        title_tag.string = chapter_title
-        soup.head.append(title_tag)
-        
-        # Link CSS
-        link_tag = soup.new_tag('link', rel='stylesheet', href='style/base.css', type='text/css')
-        soup.head.append(link_tag)
-        
-        return chapter, soup
-
-    def finalize_chapter():
-        nonlocal current_chapter, current_footers
-        if current_chapter:
-            chapter, soup = current_chapter
-            if current_footers:
-                footnotes_div = soup.new_tag('div', **{"class": "footnotes"})
-                for footer in current_footers:
-                    footnote_div = soup.new_tag('div', **{"class": "footnote"})
-                    footnote_div.append(footer)  # Append parsed HTML
-                    footnotes_div.append(footnote_div)
-                if soup.body:
-                    soup.body.append(footnotes_div)
-                current_footers.clear()
-            chapter.content = str(soup)
-            chapters.append(chapter)
-            book.add_item(chapter)
-    with open(input_path, "r", encoding="utf-8") as file:
-        for line in file:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                entry = json.loads(line)
-            except json.JSONDecodeError:
-                continue
-            label = entry.get("label", "").lower()
-            text = entry.get("text", "")
-            page = entry.get("page", 0)
-            if label == 'h1':
-                if current_header_page == page and current_header_text is not None and current_chapter is not None:
-                    current_header_text += " " + text
-                    if current_header_tag:
-                        current_header_tag.string = current_header_text
-                    current_chapter[0].title = current_header_text[:50]
-                    if current_chapter[1].head.title:
-                        current_chapter[1].head.title.string = current_header_text[:50]
-                else:
-                    finalize_chapter()
-                    chapter, soup = create_chapter(text)
-                    current_chapter = (chapter, soup)
-                    toc_structure.append((chapter, []))
-                    current_header_tag = soup.new_tag('h1')
-                    current_header_tag.string = text
-                    if soup.body:
-                        soup.body.append(current_header_tag)
-                    current_header_text = text
-                    current_header_page = page
-            elif label == 'body' and current_chapter:
-                _, soup = current_chapter
-                p_tag = soup.new_tag('p')
-                parsed_text = BeautifulSoup(text, 'html.parser')  # Parse the text as HTML
-                p_tag.append(parsed_text)  # Append the parsed HTML
-                if soup.body:
-                    soup.body.append(p_tag)
-                current_header_text = None
-                current_header_page = None
-            elif label == 'blockquote' and current_chapter:
-                _, soup = current_chapter
-                blockquote_tag = soup.new_tag('blockquote')
-                parsed_text = BeautifulSoup(text, 'html.parser')  # Parse the text as HTML
-                blockquote_tag.append(parsed_text)  # Append the parsed HTML
-                if soup.body:
-                    soup.body.append(blockquote_tag)
-                current_header_text = None
-                current_header_page = None
-            elif label == 'footer' and current_chapter:
-                parsed_text = BeautifulSoup(text, 'html.parser')  # Parse the text as HTML
-                current_footers.append(parsed_text)  # Append the parsed HTML
-                current_header_text = None
-                current_header_page = None
+        # Chapters are rendered independently, so they can be spread over worker processes and collected in order.
+        # The same pool first decodes the input in newline-aligned chunks.
+        # With a cache, only chapters whose records changed are rendered again.
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        cache = ChapterCache(cache_dir) if cache_dir else None
+        try:
+            with span("read_records", workers=workers) as info:
+                chapter_sources = split_parts(split_chapters(read_records(input_path, executor, workers, keep_blocks)), max_chapter_bytes)
+                info["chapters"] = len(chapter_sources)
+            keys = [cache.key("json", BUILDER_VERSION, css_content, language, json.dumps(source)) for source in chapter_sources] if cache else []
+            entries = [cache.get(key) for key in keys] if cache else [None] * len(chapter_sources)
+            missing = [source for source, entry in zip(chapter_sources, entries) if entry is None]
+            if executor and len(missing) > 1:
+                rendered = executor.map(render_chapter, missing, chunksize=max(1, len(missing) // (workers * 4)))
+            else:
+                rendered = map(render_chapter, missing)
 
+            chapters = []
+            toc_chapters = []
+            for i, (source, entry) in enumerate(zip(chapter_sources, entries)):
+                with span("chapter", cached=entry is not None):
+                    # Continuation files of chapter n are named chap_n_2.xhtml, chap_n_3.xhtml and so on.
+                    if source["part"]:
+                        file_name = f"chap_{len(toc_chapters)}_{source['part'] + 1}.xhtml"
+                    else:
+                        file_name = f"chap_{len(toc_chapters) + 1}.xhtml"
+                    chapter = epub.EpubHtml(title=source["title"][:50], file_name=file_name, lang=language)
+                    if not source["part"]:
+                        toc_chapters.append(chapter)
+                    chapter.content = entry["content"] if entry else next(rendered)
+                    record = {"content": chapter.content}
+                    if document is not None:
+                        document.add_file(chapter.title, file_name, chapter.content)
+                    chapters.append(chapter)
+                    book.add_item(chapter)
+                    if writer:
+                        if entry and "xhtml" in entry:
+                            writer.write_rendered(chapter, entry["xhtml"], entry["pages"])
+                        else:
+                            xhtml, record["pages"] = writer.write_item(chapter)
+                            record["xhtml"] = xhtml.decode("utf-8")
+                            entry = None
+                    if cache and not entry:
+                        cache.put(keys[i], record)
+        finally:
+            if executor:
+                executor.shutdown()
+            if cache:
+                cache.close()
+        book.toc = tuple((epub.Section(chap.title, chap.file_name), []) for chap in toc_chapters)
+        if document is not None:
+            document.set_toc(book.toc)
+        book.add_item(epub.EpubNcx())
+        book.add_item(epub.EpubNav())
+        book.spine = ['nav'] + chapters
+        with span("write_epub", streaming=bool(writer)):
+            if writer:
+                writer.close()
             else:
-                current_header_text = None
-                current_header_page = None
-    finalize_chapter()
-    book.toc = tuple((epub.Section(chap.title, chap.file_name), []) for chap, _ in toc_structure)
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-    book.spine = ['nav'] + chapters
-    output_path = f"{title}.epub"
-    epub.write_epub(output_path, book, {})
+                write_epub(output_path, book, options)
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
     print(f"Created EPUB: {output_path}")
+    if validate:
+        with span("validate_epub"):
+            require_valid_epub(output_path)
+    return output_path
 
-create_epub('input_pre.json', 'cover.jpg')
+if __name__ == "__main__":
+    create_epub('input_pre.json', 'cover.jpg', workers=os.cpu_count(), cache_dir=CACHE_DIR, keep_blocks=True)
@@ -0,0 +1,159 @@
+import html
+import os
+import struct
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from ebooklib import epub
+from ebooklib.utils import get_pages
+from temp_files import temp_path
+
+# Deflate level of the EPUB entries: 1 builds fastest, 9 gives the smallest file.
+COMPRESS_LEVEL = 6
+# Files that are compressed already and only get bigger when deflated again.
+STORED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".woff", ".woff2", ".mp3", ".mp4", ".m4a", ".ogg"}
+
+def deflate(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return zlib.crc32(data), compressor.compress(data) + compressor.flush()
+
+class ParallelZipWriter:
+    # A write-only zip file that deflates entries in a thread pool, since zlib releases the GIL, and still
+    # writes them in the order they were given, so the EPUB mimetype entry stays first. Entries in
+    # STORED_EXTENSIONS and the mimetype are stored without compression. zipfile cannot take data that is
+    # deflated already, so the headers are written here. There is no ZIP64: a book past 65535 entries or
+    # 4 GB raises zipfile.LargeZipFile before anything beyond the limit is written.
+    def __init__(self, path, compresslevel=COMPRESS_LEVEL, workers=None):
+        self.file = open(path, "wb")
+        self.level = compresslevel
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = deque()
+        self.entries = []
+        now = time.localtime()
+        self.date = ((now.tm_year - 1980) << 9) | (now.tm_mon << 5) | now.tm_mday
+        self.time = (now.tm_hour << 11) | (now.tm_min << 5) | (now.tm_sec // 2)
+
+    def writestr(self, name, data, compress_type=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if len(self.entries) + len(self.pending) >= zipfile.ZIP_FILECOUNT_LIMIT:
+            raise zipfile.LargeZipFile(f"EPUB output with more than {zipfile.ZIP_FILECOUNT_LIMIT} entries")
+        if len(data) > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile(f"{name} is larger than 4 GB")
+        if compress_type is None:
+            stored = name == "mimetype" or os.path.splitext(name)[1].lower() in STORED_EXTENSIONS
+            compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+        if compress_type == zipfile.ZIP_STORED:
+            self.pending.append((name, compress_type, len(data), None, (zlib.crc32(data), data)))
+        else:
+            self.pending.append((name, compress_type, len(data), self.executor.submit(deflate, data, self.level), None))
+        # Finished entries are written right away; a few more are kept in flight to keep the threads busy.
+        while self.pending and (len(self.pending) > 2 * self.workers or self.pending[0][3] is None or self.pending[0][3].done()):
+            self.write_entry(*self.pending.popleft())
+
+    def write_entry(self, name, compress_type, size, future, result):
+        crc, data = future.result() if future else result
+        offset = self.file.tell()
+        encoded = name.encode("utf-8")
+        if offset + 30 + len(encoded) + len(data) > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile("EPUB output larger than 4 GB")
+        flags = 0x800 if not encoded.isascii() else 0
+        header = struct.pack("<HHHHHIIIHH", 20, flags, compress_type, self.time, self.date, crc, len(data), size, len(encoded), 0)
+        self.file.write(b"PK\x03\x04" + header + encoded)
+        self.file.write(data)
+        self.entries.append((header, encoded, offset))
+
+    def close(self):
+        while self.pending:
+            self.write_entry(*self.pending.popleft())
+        self.executor.shutdown()
+        start = self.file.tell()
+        if start + sum(46 + len(encoded) for _, encoded, _ in self.entries) > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile("EPUB output larger than 4 GB")
+        for header, encoded, offset in self.entries:
+            # The central directory repeats the local header fields, made on Unix with rw-r--r-- permissions.
+            self.file.write(b"PK\x01\x02" + struct.pack("<H", (3 << 8) | 20) + header
+                            + struct.pack("<HHHII", 0, 0, 0, 0o100644 << 16, offset) + encoded)
+        end = self.file.tell()
+        self.file.write(b"PK\x05\x06" + struct.pack("<HHHHIIH", 0, 0, len(self.entries), len(self.entries), end - start, start, 0))
+        self.file.close()
+
+    def abort(self):
+        # Stops the threads and closes the file without finishing the archive.
+        self.executor.shutdown(cancel_futures=True)
+        self.file.close()
+
+class StreamingEpubWriter(epub.EpubWriter):
+    # Writes each chapter into the open zip as soon as it is finished and keeps only a small record of it,
+    # so the manifest, spine, NCX and nav can still be produced by ebooklib when the book is closed.
+    # The "compress_workers" option sets the number of deflate threads. The zip goes to temp_path until
+    # close(); a build that fails calls abort(), which leaves no partial EPUB, open file or deflate threads.
+    def __init__(self, name, book, options=None):
+        super().__init__(name, book, options)
+        self.flushed = set()
+        self.temp_path = temp_path(self.file_name)
+        self.out = ParallelZipWriter(self.temp_path, self.options["compresslevel"], self.options.get("compress_workers"))
+        try:
+            self.out.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+            self._write_container()
+        except BaseException:
+            self.abort()
+            raise
+
+    def write_item(self, item):
+        content = item.get_content()
+        # The nav page-list is collected from the chapter bodies, so only the page markers are kept.
+        pages = [(pageref, label) for _, pageref, label in get_pages(item)] if self.options.get("epub3_pages") else []
+        self.write_rendered(item, content, pages)
+        return content, pages
+
+    def write_rendered(self, item, content, pages):
+        # Also used for chapters taken from the chapter cache, whose XHTML and page markers are already known.
+        self.out.writestr(f"{self.book.FOLDER_NAME}/{item.file_name}", content)
+        item.content = '<body><div>' + ''.join(
+            f'<span epub:type="pagebreak" id="{pageref}" aria-label="{html.escape(label)}"></span>' for pageref, label in pages
+        ) + '</div></body>'
+        self.flushed.add(id(item))
+
+    def _write_items(self):
+        # Same as EpubWriter._write_items, except that chapters already written are skipped. The book's
+        # item list itself is left alone because the nav still collects its page-list from every chapter.
+        for item in self.book.get_items():
+            if id(item) in self.flushed:
+                continue
+            if isinstance(item, epub.EpubNcx):
+                self.out.writestr(f"{self.book.FOLDER_NAME}/{item.file_name}", self._get_ncx())
+            elif isinstance(item, epub.EpubNav):
+                self.out.writestr(f"{self.book.FOLDER_NAME}/{item.file_name}", self._get_nav(item))
+            elif item.manifest:
+                self.out.writestr(f"{self.book.FOLDER_NAME}/{item.file_name}", item.get_content())
+            else:
+                self.out.writestr(item.file_name, item.get_content())
+
+    def close(self):
+        try:
+            self._write_opf()
+            self._write_items()
+            self.out.close()
+        except BaseException:
+            self.abort()
+            raise
+        os.replace(self.temp_path, self.file_name)
+
+    def abort(self):
+        self.out.abort()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+def write_epub(path, book, options):
+    # epub.write_epub through temp_path, since ebooklib opens the file by name.
+    temp = temp_path(path)
+    try:
+        epub.write_epub(temp, book, options)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
@@ -0,0 +1,356 @@
+import argparse
+import difflib
+import json
+import os
+import re
+import sys
+import zlib
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from concurrent.futures import ProcessPoolExecutor
+from tracing import span
+
+CONTEXT_LENGTH = 30
+
+# Substrings that, if found right after a number, exclude it.
+FORBIDDEN = [" Millionen", " million", " Prozent", " percent", " pro", " 000", "000"]
+
+number_pattern = re.compile(r"\d+")
+header_pattern = re.compile(r"<h[123]>.*?</h[123]>", re.DOTALL)
+tag_pattern = re.compile(r"<[^>]+>")
+footer_pattern = re.compile(r"<footer>(?:\s*(\d+)\s*[—–.)-])?.*?</footer>", re.DOTALL)
+year_pattern = re.compile(r"^(19[4-9]\d|20[0-2]\d)$")
+# Characters a reference number is typically attached to, as in "word3" or "end.3".
+ATTACHED_AFTER = '.,;:!?"\'’”'
+# Matched at the end of a number: either the number is a year, or one of the forbidden
+# substrings lies within the CONTEXT_LENGTH characters that follow it.
+skip_pattern = re.compile(
+    r"(?<=(?<!\d)(?:19[4-9]\d|20[0-2]\d))|(?=" +
+    "|".join(rf"[\s\S]{{0,{CONTEXT_LENGTH - len(s)}}}{re.escape(s)}" for s in FORBIDDEN) + ")"
+)
+
+def to_bold(num_str):
+    bold_digits = {'0': '𝟎', '1': '𝟏', '2': '𝟐', '3': '𝟑', '4': '𝟒', '5': '𝟓', 
+                   '6': '𝟔', '7': '𝟕', '8': '𝟖', '9': '𝟗'}
+    return ''.join(bold_digits.get(ch, ch) for ch in num_str)
+
+def excluded_ranges(content):
+    # Headers and tags merged into sorted, non-overlapping (start, end) ranges, ends inclusive.
+    ranges = sorted([(m.start(), m.end()) for m in header_pattern.finditer(content)] +
+                    [(m.start(), m.end()) for m in tag_pattern.finditer(content)])
+    starts = []
+    ends = []
+    for start, end in ranges:
+        if ends and start <= ends[-1]:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+def make_snippet(content, start, end):
+    # A snippet of context with the number bolded.
+    snippet = (content[max(0, start - 33):start] +
+               to_bold(content[start:end]) +
+               content[end:min(len(content), end + CONTEXT_LENGTH)])
+    return snippet.replace("\n", " ")
+
+def iter_tokens(content, regions=None):
+    # Snippets are not stored with the tokens; they are built with make_snippet when a row is shown.
+    # regions limits the scan to sorted (start, end) ranges that begin and end on line boundaries.
+    starts, ends = excluded_ranges(content)
+    for region_start, region_end in regions if regions is not None else [(0, len(content))]:
+        for m in number_pattern.finditer(content, region_start, region_end):
+            # Skip if the found number falls within a header or tag.
+            i = bisect_right(starts, m.start()) - 1
+            if i >= 0 and m.start() <= ends[i]:
+                continue
+            if skip_pattern.match(content, m.end()):
+                continue
+            num_str = m.group()
+            yield {
+                "start": m.start(),
+                "end": m.end(),
+                "number": int(num_str),
+                "text": num_str,
+                "is_year": False
+            }
+
+def extract_tokens(content):
+    with span("extract_tokens", characters=len(content)) as info:
+        tokens = list(iter_tokens(content))
+        info["tokens"] = len(tokens)
+    return tokens
+
+def build_number_index(tokens):
+    # Maps each number to the sorted token positions where it appears.
+    number_index = {}
+    for i, token in enumerate(tokens):
+        number_index.setdefault(token["number"], []).append(i)
+    return number_index
+
+def find_consecutive_chain(tokens, number_index, anchor_index):
+    """
+    Starting with the token at anchor_index, find the first later occurrence of anchor_number+1,
+    then the first occurrence of anchor_number+2 after that one, and so on. Returns the token indices.
+    """
+    result_indices = []
+    next_expected = tokens[anchor_index]["number"] + 1
+    search_start = anchor_index + 1
+    while True:
+        position = first_occurrence(number_index, next_expected, search_start)
+        if position is None:
+            break
+        result_indices.append(position)
+        search_start = position + 1
+        next_expected += 1
+    return result_indices
+
+def first_occurrence(number_index, number, start, end=None):
+    # The first token index of number at or after start and before end, or None. One step of the chain.
+    positions = number_index.get(number, [])
+    i = bisect_left(positions, start)
+    if i == len(positions) or (end is not None and positions[i] >= end):
+        return None
+    return positions[i]
+
+def diff_segments(old_content, content):
+    # Lines left unchanged between the two texts, as (old_start, old_end, new_start) character ranges.
+    old_lines = old_content.splitlines(keepends=True)
+    new_lines = content.splitlines(keepends=True)
+    old_offsets = [0]
+    old_offsets.extend(accumulate(len(line) for line in old_lines))
+    new_offsets = [0]
+    new_offsets.extend(accumulate(len(line) for line in new_lines))
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    return [(old_offsets[i], old_offsets[i + size], new_offsets[j])
+            for i, j, size in matcher.get_matching_blocks() if size]
+
+def retokenize(old_content, content, tokens, segments):
+    """
+    Tokens for the new text, reusing the old tokens of unchanged lines. Lines are scanned again when they
+    were changed, when a number on them could see a change within CONTEXT_LENGTH characters, or when a
+    header or tag that decides whether they count reaches over a change, in either version of the text.
+    """
+    new_segments = [(new_start, new_start + old_end - old_start) for old_start, old_end, new_start in segments]
+    dirty = []
+    old_position = new_position = 0
+    for old_start, old_end, new_start in segments:
+        if old_position < old_start or new_position < new_start:
+            dirty.append((new_position, new_start))
+        old_position, new_position = old_end, new_start + old_end - old_start
+    if old_position < len(old_content) or new_position < len(content):
+        dirty.append((new_position, len(content)))
+    for ranges, spans, moved in ((excluded_ranges(content), new_segments, False),
+                                 (excluded_ranges(old_content), [(s[0], s[1]) for s in segments], True)):
+        span_starts = [start for start, _ in spans]
+        for start, end in zip(*ranges):
+            i = bisect_right(span_starts, start) - 1
+            if i < 0 or end >= spans[i][1]:
+                dirty.append((map_offset(segments, start), map_offset(segments, end) + 1) if moved else (start, end + 1))
+    regions = []
+    for start, end in sorted(dirty):
+        start = content.rfind("\n", 0, max(0, start - CONTEXT_LENGTH)) + 1
+        end = content.find("\n", min(end, len(content))) + 1 or len(content)
+        if regions and start <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], max(regions[-1][1], end))
+        else:
+            regions.append((start, end))
+
+    region_starts = [start for start, _ in regions]
+    old_segment_starts = [old_start for old_start, _, _ in segments]
+    kept = []
+    for token in tokens:
+        i = bisect_right(old_segment_starts, token["start"]) - 1
+        if i < 0 or token["end"] > segments[i][1]:
+            continue
+        start = token["start"] + segments[i][2] - segments[i][0]
+        j = bisect_right(region_starts, start) - 1
+        if j < 0 or start >= regions[j][1]:
+            kept.append(dict(token, start=start, end=start + token["end"] - token["start"]))
+    scanned = list(iter_tokens(content, regions))
+    return sorted(kept + scanned, key=lambda token: token["start"])
+
+def map_offset(segments, position):
+    # Moves an offset in the old text by the shift of the nearest unchanged stretch at or before it.
+    i = bisect_right(segments, (position, float("inf"))) - 1
+    if i < 0:
+        return position
+    old_start, _, new_start = segments[i]
+    return position + new_start - old_start
+
+def context_checksum(content, start, end):
+    return zlib.crc32(content[max(0, start - CONTEXT_LENGTH):end + CONTEXT_LENGTH].encode("utf-8"))
+
+def selection_record(content, token):
+    return {"start": token["start"], "text": token["text"], "context": context_checksum(content, token["start"], token["end"])}
+
+def relocate_selections(content, tokens, number_index, selections, segments=None):
+    """
+    Finds the tokens saved selections now belong to. A selection only survives if a token with the same
+    number and the same surrounding context exists; the one closest to the expected offset is taken.
+    """
+    by_start = {token["start"]: i for i, token in enumerate(tokens)}
+    found = set()
+    for selection in selections:
+        expected = map_offset(segments, selection["start"]) if segments else selection["start"]
+
+        def matches(i):
+            token = tokens[i]
+            return token["text"] == selection["text"] and context_checksum(content, token["start"], token["end"]) == selection["context"]
+
+        i = by_start.get(expected)
+        if i is not None and matches(i):
+            found.add(i)
+            continue
+        candidates = [i for i in number_index.get(int(selection["text"]), []) if matches(i)]
+        if candidates:
+            found.add(min(candidates, key=lambda i: abs(tokens[i]["start"] - expected)))
+    return found
+
+def derived_path(path, suffix):
+    # A file next to path named after it: input_pre.txt gives input_pre_sel.json for suffix "_sel.json".
+    # Output that would land on path itself is refused, since that would overwrite the source text.
+    output_path = os.path.splitext(path)[0] + suffix
+    if os.path.abspath(output_path) == os.path.abspath(path):
+        raise ValueError(f"{path} would be overwritten by its own output")
+    return output_path
+
+def selections_path(path):
+    return derived_path(path, "_sel.json")
+
+def tagged_path(path):
+    return derived_path(path, "_s" + os.path.splitext(path)[1])
+
+def apply_sup(content, tokens):
+    # Wraps the given tokens in <sup> tags, in order of their position in content.
+    result_parts = []
+    current_index = 0
+    for token in sorted(tokens, key=lambda t: t["start"]):
+        start, end = token["start"], token["end"]
+        result_parts.append(content[current_index:start])
+        result_parts.append(f"<sup>{token['text']}</sup>")
+        current_index = end
+    result_parts.append(content[current_index:])
+    return "".join(result_parts)
+
+def is_attached(content, start):
+    return start > 0 and (content[start - 1].isalpha() or content[start - 1] in ATTACHED_AFTER)
+
+def match_footnotes(content, tokens, footers):
+    """
+    Uses the footer numbering as the anchors of the consecutive chain. The reference for footnote N is searched
+    between the previous reference and the footer of N. When the numbering restarts (a new chapter or page),
+    the search starts again after the previous footer. Tokens inside footers are never used.
+    Without a number attached to a word, the pick is the chain step of find_consecutive_chain, the first
+    occurrence after the previous reference, so the tagger and the GUI chain agree. The footers bound the
+    search, which the GUI chain does not have.
+    Each result records how many tokens could have been the reference and how confident the pick is.
+    """
+    footer_starts = [start for start, _, _ in footers]
+    footer_ends = [end for _, end, _ in footers]
+    text_tokens = []
+    for token in tokens:
+        i = bisect_right(footer_starts, token["start"]) - 1
+        if i < 0 or token["start"] >= footer_ends[i]:
+            text_tokens.append(token)
+    starts = [token["start"] for token in text_tokens]
+    number_index = build_number_index(text_tokens)
+
+    references = []
+    search_from = 0
+    previous_number = None
+    previous_end = 0
+    for footer_start, footer_end, number in footers:
+        if number is None:
+            continue
+        if previous_number is not None and number <= previous_number:
+            search_from = previous_end
+        first = bisect_left(starts, search_from)
+        end = bisect_left(starts, footer_start)
+        positions = number_index.get(number, [])
+        candidates = [text_tokens[i] for i in positions[bisect_left(positions, first):bisect_left(positions, end)]]
+        attached = [token for token in candidates if is_attached(content, token["start"])]
+        reference = {"number": number, "footer": footer_start, "start": None, "end": None,
+                     "candidates": len(candidates), "confidence": "missing"}
+        if candidates:
+            chosen = attached[0] if attached else text_tokens[first_occurrence(number_index, number, first, end)]
+            reference["start"] = chosen["start"]
+            reference["end"] = chosen["end"]
+            reference["confidence"] = "high" if len(candidates) == 1 or len(attached) == 1 else "low"
+            search_from = chosen["end"]
+        references.append(reference)
+        previous_number = number
+        previous_end = footer_end
+    return references
+
+def report_path(path):
+    return derived_path(path, "_refs.json")
+
+def load_report(path):
+    with open(report_path(path), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def tag_file(path):
+    # Writes the tagged _s.txt next to the input, plus a _refs.json report for review in select_superscript.py.
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    footers = [(m.start(), m.end(), int(m.group(1)) if m.group(1) else None) for m in footer_pattern.finditer(content)]
+    tokens = extract_tokens(content)
+    with span("match_footnotes", footers=len(footers)):
+        references = match_footnotes(content, tokens, footers)
+    tagged = [{"start": r["start"], "end": r["end"], "text": content[r["start"]:r["end"]]}
+              for r in references if r["start"] is not None]
+    output_path = tagged_path(path)
+    output_report_path = report_path(path)
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(apply_sup(content, tagged))
+    report = {
+        "source": path,
+        "footnotes": len(references),
+        "tagged": len(tagged),
+        "review": sum(1 for r in references if r["confidence"] != "high"),
+        "references": references,
+    }
+    with open(output_report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+def tag_book(path):
+    # Runs in a worker process. Failures are returned instead of raised, so one bad book does not stop the run.
+    try:
+        return tag_file(path)
+    except Exception as e:
+        return {"source": path, "error": f"{type(e).__name__}: {e}"}
+
+def find_inputs(paths, name):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                if name in files:
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tag footnote references with <sup> without the selector GUI.")
+    parser.add_argument("paths", nargs="*", default=["input_pre.txt"], help="text files, or directories to search for --name")
+    parser.add_argument("--name", default="input_pre.txt", help="file name to look for in directories")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    inputs = list(find_inputs(args.paths, args.name))
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for report in executor.map(tag_book, inputs):
+            if "error" in report:
+                print(f"FAILED {report['source']}: {report['error']}")
+                failed.append(report)
+                continue
+            note = f" ({report['review']} to review)" if report["review"] else ""
+            print(f"Tagged {report['tagged']}/{report['footnotes']} references in {report['source']}{note}")
+    if failed:
+        print(f"{len(failed)} of {len(inputs)} files failed:")
+        for report in failed:
+            print(f"  {report['source']}")
+        sys.exit(1)
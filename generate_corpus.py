@@ -0,0 +1,129 @@
+import argparse
+import json
+import random
+
+WORDS = ("the of and to in a is that for it as was with be by on not he this are or his from at which but have "
+         "an they you were her she there been one all we their has would when if so no more time people years "
+         "government history country between through against during without question evidence argument "
+         "together important different development because however political economic national").split()
+LINE_WIDTH = 70
+
+def make_sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+def make_text(rng, words):
+    parts = []
+    while words > 0:
+        length = min(words, rng.randint(6, 20))
+        parts.append(make_sentence(rng, length))
+        words -= length
+    return " ".join(parts)
+
+def wrap_block(rng, tag, text, hyphenation_rate):
+    # Breaks the text into lines like the classifier output, splitting some words over a line end with a hyphen.
+    lines = []
+    line = ""
+    for word in text.split(" "):
+        if line and len(line) + len(word) + 1 > LINE_WIDTH:
+            if len(word) > 5 and rng.random() < hyphenation_rate:
+                cut = rng.randint(2, len(word) - 2)
+                lines.append(line + " " + word[:cut] + "-")
+                line = word[cut:]
+                continue
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    lines.append(line)
+    lines[0] = f"<{tag}>" + lines[0]
+    lines[-1] += f"</{tag}>"
+    return lines
+
+def generate(pages=300, seed=0, chapter_rate=0.05, heading_rate=0.1, footnotes_per_page=0.5, hyphenation_rate=0.3,
+             page_restarts=1, blockquote_rate=0.05, paragraphs_per_page=6):
+    """
+    Returns (lines, records): the raw classifier text as a list of lines, and the blocks exactly as
+    page_numbering and pre_processing write them, as (label, text, page) records with continuous page numbers.
+    """
+    rng = random.Random(seed)
+    restart_pages = {pages * (i + 1) // (page_restarts + 1) + 1 for i in range(page_restarts)}
+    lines = []
+    records = []
+    printed_page = 0
+    chapter = 0
+    footnote = 0
+    carried = None
+
+    def add_block(tag, text, page, raw_text=None):
+        lines.extend(wrap_block(rng, tag, raw_text if raw_text is not None else text, hyphenation_rate))
+        lines.append(f"<{printed_page}>")
+        lines.append("")
+        records.append((tag, text, page))
+
+    for page in range(1, pages + 1):
+        printed_page = 1 if page in restart_pages else printed_page + 1
+        if page == 1 or rng.random() < chapter_rate:
+            chapter += 1
+            footnote = 0
+            add_block("h1", f"Chapter {chapter}", page)
+        notes = []
+        for _ in range(max(1, int(rng.gauss(paragraphs_per_page, 1.5)))):
+            roll = rng.random()
+            if roll < heading_rate:
+                tag = "h2" if rng.random() < 0.7 else "h3"
+                add_block(tag, make_sentence(rng, rng.randint(2, 6))[:-1], page)
+                continue
+            tag = "blockquote" if roll < heading_rate + blockquote_rate else "body"
+            text = make_text(rng, rng.randint(20, 120))
+            if tag == "body" and rng.random() < footnotes_per_page / paragraphs_per_page:
+                footnote += 1
+                notes.append(footnote)
+                words = text.split(" ")
+                position = rng.randrange(len(words))
+                words[position] = words[position].rstrip(".") + str(footnote) + ("." if words[position].endswith(".") else "")
+                text = " ".join(words)
+            raw_text = text
+            if carried and tag == "body":
+                # The previous page ended in the middle of a word, which continues here.
+                text = carried[0] + carried[1] + " " + text
+                raw_text = carried[1] + " " + raw_text
+                carried = None
+            add_block(tag, text, page, raw_text)
+        if carried is None and rng.random() < hyphenation_rate / 3:
+            # A paragraph that breaks off at the page end in the middle of a word.
+            text = make_text(rng, rng.randint(20, 60))[:-1]
+            word = rng.choice([w for w in WORDS if len(w) > 6])
+            cut = rng.randint(2, len(word) - 2)
+            carried = (word[:cut], word[cut:])
+            # Pre-processing moves the fragment to the next page and keeps the space before it.
+            add_block("body", text + " ", page, f"{text} {carried[0]}-")
+        for number in notes:
+            add_block("footer", f"{number}—" + make_text(rng, rng.randint(8, 30)), page)
+    return lines, records
+
+def write_corpus(text_path, json_path=None, **options):
+    lines, records = generate(**options)
+    with open(text_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            for label, text, page in records:
+                f.write(json.dumps({"label": label, "text": text, "page": page}, ensure_ascii=False) + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic book in the classifier text format.")
+    parser.add_argument("output", nargs="?", default="input.txt")
+    parser.add_argument("--json", help="also write the pre-processed blocks as JSONL here")
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chapter-rate", type=float, default=0.05, help="chance that a page starts a chapter")
+    parser.add_argument("--heading-rate", type=float, default=0.1, help="chance that a block is an h2 or h3")
+    parser.add_argument("--footnotes-per-page", type=float, default=0.5)
+    parser.add_argument("--hyphenation-rate", type=float, default=0.3, help="chance that a line break splits a word")
+    parser.add_argument("--page-restarts", type=int, default=1, help="times the printed page numbers start again at 1")
+    parser.add_argument("--blockquote-rate", type=float, default=0.05)
+    args = parser.parse_args()
+    write_corpus(args.output, args.json, pages=args.pages, seed=args.seed, chapter_rate=args.chapter_rate,
+                 heading_rate=args.heading_rate, footnotes_per_page=args.footnotes_per_page,
+                 hyphenation_rate=args.hyphenation_rate, page_restarts=args.page_restarts,
+                 blockquote_rate=args.blockquote_rate)
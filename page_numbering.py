@@ -1,14 +1,89 @@
+import mmap
+import os
 import re
+from array import array
+from bisect import bisect_left, bisect_right
+from temp_files import replacing
+from tracing import span
 
-def process_file():
-    input_file = "input.txt"
-    output_file = "input_page.txt"
-    with open(input_file, "r", encoding="utf-8") as f:
-        lines = [line.rstrip("\n") for line in f]
-    page_re = re.compile(r"^<\s*(\d+)\s*>$")
-    blocks = []
+page_re = re.compile(r"^<\s*(\d+)\s*>$")
+
+def page_index_path(text_path):
+    return text_path + ".pages"
+
+def write_page_index(path, index):
+    # Flat array of (byte offset, page) pairs, one pair per block, in file order.
+    flat = array("q")
+    for offset, page in index:
+        flat.append(offset)
+        flat.append(page)
+    with replacing(path, "wb") as f:
+        flat.tofile(f)
+
+def load_page_index(path):
+    flat = array("q")
+    with open(path, "rb") as f:
+        flat.frombytes(f.read())
+    return list(zip(flat[0::2], flat[1::2]))
+
+def index_lines(lines, index):
+    # Passes text lines through while recording, for every page marker, the byte offset where its block starts.
+    offset = 0
+    block_start = None
+    for line in lines:
+        stripped = line.rstrip("\n")
+        if block_start is None and stripped.strip():
+            block_start = offset
+        m = page_re.fullmatch(stripped)
+        if m:
+            index.append((block_start, int(m.group(1))))
+            block_start = None
+        offset += len(line.encode("utf-8"))
+        yield line
+
+def iter_mapped_lines(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b""):
+                # Text mode would turn Windows line ends into \n, which the markers are matched against.
+                line = line.decode("utf-8")
+                if line.endswith("\r\n"):
+                    line = line[:-2] + "\n"
+                elif line.endswith("\r"):
+                    line = line[:-1] + "\n"
+                yield line
+
+def build_page_index(input_file):
+    # Page index of the renumbered text, computed without writing it.
+    index = []
+    for _ in index_lines(renumber_pages(iter_mapped_lines(input_file)), index):
+        pass
+    return index
+
+def read_pages(text_path, first, last, index=None):
+    # Returns the blocks of pages first..last without scanning the text before them.
+    if index is None:
+        index = load_page_index(page_index_path(text_path))
+    pages = [page for _, page in index]
+    start = bisect_left(pages, first)
+    end = bisect_right(pages, last)
+    if start >= end:
+        return ""
+    with open(text_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        stop = index[end][0] if end < len(index) else len(mm)
+        return mm[index[start][0]:stop].decode("utf-8")
+
+def renumber_pages(lines):
+    # Yields the output lines as soon as each block's page marker is read. Page numbers that restart
+    # continue from the highest page of the previous series.
     current_content = []
+    series_offset = 0
+    current_series_max = None
+    prev_page = None
     for line_num, line in enumerate(lines, 1):
+        line = line.rstrip("\n")
         if line.strip() == "":
             continue
         m = page_re.fullmatch(line)
@@ -16,38 +91,39 @@ def process_file():
             if not current_content:
                 raise ValueError(f"Malformed input: Page number encountered without preceding content (line {line_num}).")
             try:
-                page = int(m.group(1))
+                orig = int(m.group(1))
             except Exception:
                 raise ValueError(f"Malformed input: Cannot parse page number on line {line_num}.")
-            blocks.append({"content": current_content, "orig_page": page, "line_num": line_num})
+            if prev_page is None:
+                if orig != 1:
+                    raise ValueError(f"Malformed input: The first block must start with page number 1 (block starting at line {line_num}).")
+                current_series_max = orig
+            elif orig < prev_page:
+                series_offset += current_series_max
+                current_series_max = orig
+            elif orig > current_series_max:
+                current_series_max = orig
+            prev_page = orig
+            for content_line in current_content:
+                yield f"{content_line}\n"
+            yield f"<{series_offset + orig}>\n"
+            yield "\n"
             current_content = []
         else:
             current_content.append(line)
     if current_content:
         raise ValueError("Malformed input: File ended before a page number was found for the last block.")
-    series_offset = 0
-    current_series_max = None
-    for idx, block in enumerate(blocks):
-        orig = block["orig_page"]
-        if idx == 0:
-            if orig != 1:
-                raise ValueError(f"Malformed input: The first block must start with page number 1 (block starting at line {block['line_num']}).")
-            current_series_max = orig
-        else:
-            prev = blocks[idx - 1]["orig_page"]
-            if orig < prev:
-                series_offset += current_series_max
-                current_series_max = orig
-            else:
-                if orig > current_series_max:
-                    current_series_max = orig
-        block["new_page"] = series_offset + orig
-    with open(output_file, "w", encoding="utf-8") as f:
-        for block in blocks:
-            for line in block["content"]:
-                f.write(f"{line}\n")
-            f.write(f"<{block['new_page']}>\n\n")
+
+def process_file(input_file="input.txt", output_file="input_page.txt"):
+    # One pass over the memory-mapped input writes the renumbered text and its page index.
+    # Malformed input raises before the output is replaced.
+    index = []
+    with span("page_numbering", input=input_file) as info:
+        with replacing(output_file, encoding="utf-8", newline="\n") as out:
+            out.writelines(index_lines(renumber_pages(iter_mapped_lines(input_file)), index))
+        info["blocks"] = len(index)
+    with span("write_page_index"):
+        write_page_index(page_index_path(output_file), index)
 
 if __name__ == "__main__":
     process_file()
-
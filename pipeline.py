@@ -0,0 +1,48 @@
+import argparse
+import os
+from page_numbering import build_page_index, renumber_pages
+from pre_processing import count_words, process_lines
+from create_epub import MAX_CHAPTER_BYTES, create_epub_from_lines
+from epub_writer import COMPRESS_LEVEL
+from tracing import span
+
+def dump_lines(lines, path):
+    # Passes the lines through unchanged while also writing them to path.
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        for line in lines:
+            f.write(line)
+            yield line
+
+def run_pipeline(input_path='input.txt', metadata_path='metadata.json', cover_path='cover.jpg', dump_dir=None, cache_dir=None, max_chapter_bytes=MAX_CHAPTER_BYTES, compress_level=COMPRESS_LEVEL):
+    # Page renumbering, block joining and EPUB building run as one chain of generators,
+    # so no stage ever holds the whole book and no intermediate files are needed.
+    if dump_dir:
+        os.makedirs(dump_dir, exist_ok=True)
+    # A quick first pass over the mapped input finds the page of every block for the EPUB page-list.
+    with span("build_page_index"):
+        page_index = build_page_index(input_path)
+    # Another one counts the words, so hyphens at line ends can be told apart from compounds.
+    with span("count_words"):
+        with open(input_path, "r", encoding="utf-8") as file:
+            words = count_words(file)
+    with open(input_path, "r", encoding="utf-8") as file:
+        lines = renumber_pages(file)
+        if dump_dir:
+            lines = dump_lines(lines, os.path.join(dump_dir, "input_page.txt"))
+        lines = process_lines(lines, words)
+        if dump_dir:
+            lines = dump_lines(lines, os.path.join(dump_dir, "input_pre.txt"))
+        create_epub_from_lines(lines, metadata_path, cover_path, page_index=page_index, cache_dir=cache_dir,
+                               max_chapter_bytes=max_chapter_bytes, compress_level=compress_level)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a classifier text file to EPUB in one pass.")
+    parser.add_argument("input", nargs="?", default="input.txt")
+    parser.add_argument("--metadata", default="metadata.json")
+    parser.add_argument("--cover", default="cover.jpg")
+    parser.add_argument("--dump-dir", help="also write the intermediate input_page.txt and input_pre.txt here")
+    parser.add_argument("--cache-dir", help="reuse chapters rendered by earlier runs from this directory")
+    parser.add_argument("--max-chapter-kb", type=int, default=MAX_CHAPTER_BYTES // 1024, help="continue longer chapters in another file, 0 to never split")
+    parser.add_argument("--compress-level", type=int, default=COMPRESS_LEVEL, choices=range(10), help="deflate level of the EPUB, 1 fastest, 9 smallest")
+    args = parser.parse_args()
+    run_pipeline(args.input, args.metadata, args.cover, args.dump_dir, args.cache_dir, args.max_chapter_kb * 1024, args.compress_level)
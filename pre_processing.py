@@ -1,42 +1,100 @@
 import re
+from collections import Counter
+from page_numbering import index_lines, page_index_path, write_page_index
+from blocks import BlockWriter, blocks_path, collect_blocks
+from temp_files import replacing
+from tracing import span
 
 allowed_tags = {"body", "h1", "h2", "h3", "blockquote", "footer"}
 
-def remove_leading(line):
-    while line and line[0] in " \t":
-        line = line[1:]
-    return line
+word_pattern = re.compile(r"[^\W\d_]+(?:-[^\W\d_]+)*")
+markup_pattern = re.compile(r"<[^>]*>")
+left_word_pattern = re.compile(r"[^\W\d_]+$")
+right_word_pattern = re.compile(r"[^\W\d_]+")
 
-def join_line_pair(current_line, next_line):
-    trimmed = current_line.rstrip(" \t")
-    if trimmed.endswith("-"):
-        return trimmed[:-1] + next_line
-    elif current_line.endswith(" "):
-        return current_line + next_line
-    elif current_line and current_line[-1].isalpha():
-        return current_line + " " + next_line
-    else:
-        return current_line + " " + next_line
+def count_words(lines):
+    # One pass over the document, counting every word and hyphenated compound that sits inside a line.
+    # Fragments of words broken at a line end are left out, so they do not look like words of their own.
+    words = Counter()
+    broken = False
+    for line in lines:
+        text = line.rstrip().lower()
+        if "<" in text:
+            text = markup_pattern.sub(" ", text).rstrip()
+        found = word_pattern.findall(text)
+        if not found:
+            continue
+        if broken:
+            del found[0]
+        broken = text.endswith("-")
+        if broken and found:
+            del found[-1]
+        words.update(found)
+    return words
+
+def keep_hyphen(left, right, words):
+    # Decides whether a hyphen at a line end belongs to a compound ("well-known") or only splits a word
+    # ("con-tinued"). The hyphen is kept only when the document uses the hyphenated form more often than
+    # the joined one, so words seen nowhere else are joined.
+    if words is None:
+        return False
+    if left[-1:].isdigit() and right[:1].isdigit():
+        return True
+    a = left_word_pattern.search(left)
+    b = right_word_pattern.match(right)
+    if not a or not b:
+        return False
+    a = a.group()
+    b = b.group()
+    if b[0].isupper() and not b.isupper():
+        return True
+    hyphenated = words.get(f"{a}-{b}".lower(), 0)
+    joined = words.get((a + b).lower(), 0)
+    return hyphenated > joined
+
+def rstrip_parts(parts):
+    # Removes the spaces and tabs at the end of the joined parts.
+    while parts and not parts[-1].rstrip(" \t"):
+        parts.pop()
+    if parts:
+        parts[-1] = parts[-1].rstrip(" \t")
 
-def join_lines_in_block(block_lines):
-    lines = [remove_leading(line.rstrip("\n")) for line in block_lines]
-    if not lines:
-        return ""
-    joined = lines[0]
-    for line in lines[1:]:
-        joined = join_line_pair(joined, line)
-    return joined
+def last_word_end(parts):
+    # The end of the joined parts from the last part that is not only letters, so it holds the last word.
+    i = len(parts) - 1
+    while i > 0 and parts[i].isalpha():
+        i -= 1
+    return "".join(parts[i:])
 
-def process_text_block(block_lines, tag):
+def join_lines_in_block(block_lines, words=None):
+    # The parts are collected and joined once, so long blocks stay linear, and each step only looks at the
+    # end of the parts. Empty lines are joined like any other line, as when the lines were joined pair by pair.
+    parts = []
+    for i, line in enumerate(block_lines):
+        line = line.rstrip("\n").lstrip(" \t")
+        if i:
+            end = next((part for part in reversed(parts) if part.strip(" \t")), "")
+            if end.rstrip(" \t").endswith("-"):
+                rstrip_parts(parts)
+                parts[-1] = parts[-1][:-1]
+                if not parts[-1]:
+                    parts.pop()
+                if keep_hyphen(last_word_end(parts), line, words):
+                    parts.append("-")
+            elif not (parts and parts[-1].endswith(" ")):
+                parts.append(" ")
+        if line:
+            parts.append(line)
+    return "".join(parts)
+
+allowed_tags_pattern = '|'.join(sorted(allowed_tags))
+block_open_pattern = re.compile(rf'<({allowed_tags_pattern})>')
+block_line_pattern = re.compile(rf'^<({allowed_tags_pattern})>(.*)</\1>$')
+closing_tags = {tag: f"</{tag}>" for tag in allowed_tags}
+
+def process_text_block(block_lines, tag, words=None):
     if len(block_lines) == 1:
-        line = block_lines[0].rstrip("\n")
-        pattern = re.compile(rf'^<{tag}>(.*)</{tag}>$')
-        m = pattern.match(line)
-        if m:
-            content = m.group(1)
-            return f"<{tag}>{content}</{tag}>\n"
-        else:
-            return line + "\n"
+        return block_lines[0].rstrip("\n") + "\n"
     else:
         stripped_lines = [l.rstrip("\n") for l in block_lines]
         first_line = stripped_lines[0]
@@ -54,88 +112,82 @@ def process_text_block(block_lines, tag):
         content_lines.extend(middle_lines)
         if last_text:
             content_lines.append(last_text)
-        joined_content = join_lines_in_block(content_lines)
+        joined_content = join_lines_in_block(content_lines, words)
         return opening_tag + joined_content + closing_tag + "\n"
 
-def process_file(file_path='input.txt', output_path='input_pre.txt'):
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
-    output_lines = []
-    inside_block = False
+def assemble_blocks(lines, words=None):
+    # Joins each tagged block that spans several lines into one line, passing other lines through.
+    # A block still open at the end of the input is dropped.
     current_block_lines = []
     current_tag = None
     for line in lines:
-        if not inside_block:
-            found_tag = None
-            for tag in allowed_tags:
-                if line.lstrip().startswith(f"<{tag}>"):
-                    found_tag = tag
-                    break
-            if found_tag:
-                current_tag = found_tag
-                current_block_lines = [line]
-                if f"</{current_tag}>" in line:
-                    processed = process_text_block(current_block_lines, current_tag)
-                    output_lines.append(processed)
-                    current_block_lines = []
-                    current_tag = None
-                else:
-                    inside_block = True
-            else:
-                output_lines.append(line)
+        if current_tag is None:
+            m = block_open_pattern.match(line.lstrip())
+            if not m:
+                yield line
+                continue
+            current_tag = m.group(1)
+            current_block_lines = [line]
         else:
             current_block_lines.append(line)
-            if f"</{current_tag}>" in line:
-                processed = process_text_block(current_block_lines, current_tag)
-                output_lines.append(processed)
-                inside_block = False
-                current_block_lines = []
-                current_tag = None
+        if closing_tags[current_tag] in line:
+            yield process_text_block(current_block_lines, current_tag, words)
+            current_block_lines = []
+            current_tag = None
+
+def carry_hyphens(lines, words=None):
+    # A block whose content ends in '-' hands its last word fragment to the next block with the same tag.
+    # Fragments waiting for their block are kept per tag, so each line is looked at once.
+    pending = {}
+    for line in lines:
+        m = block_line_pattern.match(line.rstrip('\n'))
+        if not m:
+            yield line
+            continue
+        tag = m.group(1)
+        content = m.group(2)
+        moved_part = pending.pop(tag, None)
+        if moved_part is not None:
+            content = moved_part + ("-" if keep_hyphen(moved_part, content, words) else "") + content
+            line = f"<{tag}>{content}</{tag}>\n"
+        if content.endswith('-'):
+            # Split content to remove hyphen and move the preceding part
+            content_without_hyphen = content[:-1]
+            last_space = content_without_hyphen.rfind(' ')
+            if last_space == -1:
+                current_content = ''
+                pending[tag] = content_without_hyphen
+            else:
+                current_content = content_without_hyphen[:last_space + 1]
+                pending[tag] = content_without_hyphen[last_space + 1:]
+            line = f"<{tag}>{current_content}</{tag}>\n"
+        yield line
 
-    # New step to handle '-</tag>' cases
-    i = 0
-    while i < len(output_lines):
-        line = output_lines[i].rstrip('\n')  # Process without newline
-        # Check if the line matches a block tag with content ending in '-'
-        pattern = re.compile(r'^<({})>(.*)</\1>$'.format('|'.join(allowed_tags)))
-        m = pattern.match(line)
-        if m:
-            tag = m.group(1)
-            content = m.group(2)
-            if content.endswith('-'):
-                # Split content to remove hyphen and move the preceding part
-                content_without_hyphen = content[:-1]
-                last_space = content_without_hyphen.rfind(' ')
-                if last_space == -1:
-                    current_content = ''
-                    moved_part = content_without_hyphen
-                else:
-                    current_content = content_without_hyphen[:last_space + 1]
-                    moved_part = content_without_hyphen[last_space + 1:]
-                # Update current line
-                new_line = f"<{tag}>{current_content}</{tag}>\n"
-                output_lines[i] = new_line
-                # Find the next occurrence of the same tag
-                j = i + 1
-                found = False
-                while j < len(output_lines):
-                    next_line = output_lines[j].rstrip('\n')
-                    m_next = pattern.match(next_line)
-                    if m_next and m_next.group(1) == tag:
-                        # Modify the next block's content
-                        next_content = m_next.group(2)
-                        new_next_content = moved_part + next_content
-                        new_next_line = f"<{tag}>{new_next_content}</{tag}>\n"
-                        output_lines[j] = new_next_line
-                        found = True
-                        break
-                    j += 1
-                if not found:
-                    pass  # Handle cases where no next block is found if necessary
-        i += 1
+def process_lines(lines, words=None):
+    # Without a word table every hyphen at a line end is removed.
+    return carry_hyphens(assemble_blocks(lines, words), words)
 
-    with open(output_path, 'w') as out_file:
-        out_file.writelines(output_lines)
+def process_file(file_path='input.txt', output_path='input_pre.txt'):
+    # Blocks keep their page markers, so the output gets a page index of its own. Its offsets count UTF-8
+    # bytes with \n line ends, which is how the output is written on every platform. The blocks are also
+    # written in the binary block format, which the EPUB builder loads without parsing the text again.
+    index = []
+    with span("count_words", input=file_path) as info:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            words = count_words(f)
+        info["words"] = len(words)
+    with span("pre_processing", input=file_path) as info:
+        writer = BlockWriter(blocks_path(output_path))
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f, replacing(output_path, encoding='utf-8', newline='\n') as out_file:
+                out_file.writelines(index_lines(collect_blocks(process_lines(f, words), writer), index))
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+        info["blocks"] = len(index)
+    with span("write_page_index"):
+        write_page_index(page_index_path(output_path), index)
 
 if __name__ == "__main__":
     process_file()
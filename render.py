@@ -0,0 +1,148 @@
+import argparse
+import html
+import json
+import os
+import re
+import tempfile
+from chapter_cache import CACHE_DIR
+from create_epub import create_epub_from_textfile
+from create_epub_json import create_epub
+from tracing import span
+
+TARGETS = ("epub", "html", "txt")
+body_tag_pattern = re.compile(r"<(/?)body>")
+section_id_pattern = re.compile(r' id="((?:sub)?sec_[0-9_]+)"')
+block_end_pattern = re.compile(r"</(?:p|h1|h2|h3|blockquote|div)>")
+markup_pattern = re.compile(r"<[^>]*>")
+
+def body_of(content):
+    # The markup inside the outer body of a chapter file, for both the text builder's '<body>...</body>'
+    # and the JSON builder's whole HTML page.
+    start = content.find("<body")
+    start = content.find(">", start) + 1 if start != -1 else 0
+    end = content.rfind("</body>")
+    return content[start:end if end >= start else len(content)]
+
+class Document:
+    # The book as the builders assemble it: metadata, every chapter file in reading order with the markup of
+    # its body, and the table of contents with file#id targets. A builder given a Document fills it while it
+    # writes the EPUB, so other targets are rendered from it without parsing the input again.
+    def __init__(self):
+        self.title = "Untitled Book"
+        self.author = "Unknown Author"
+        self.language = "en"
+        self.css = ""
+        self.files = []
+        self.toc = []
+
+    def set_metadata(self, title, author, language, css):
+        self.title = title
+        self.author = author
+        self.language = language
+        self.css = css
+
+    def add_file(self, title, file_name, content):
+        self.files.append((title, file_name, body_of(content)))
+
+    def set_toc(self, toc):
+        # Takes the EPUB table of contents of Sections and Links as plain (title, href, children) tuples.
+        self.toc = [(section.title, section.href,
+                     [(h2.title, h2.href, [(link.title, link.href) for link in links]) for h2, links in entries])
+                    for section, entries in toc]
+
+def file_anchor(file_name):
+    return file_name[:-len(".xhtml")]
+
+def chapter_anchor(file_name):
+    # Ids of sections are numbered per chapter, so continuation files share the prefix of their chapter.
+    return "_".join(file_anchor(file_name).split("_")[:2])
+
+def local_href(href):
+    file_name, _, fragment = href.partition("#")
+    if not fragment:
+        return f"#{file_anchor(file_name)}"
+    if fragment.startswith(("sec_", "subsec_")):
+        return f"#{chapter_anchor(file_name)}-{fragment}"
+    return f"#{fragment}"
+
+def toc_html(toc):
+    def items(entries):
+        return "<ol>" + "".join(f'<li><a href="{html.escape(local_href(href))}">{html.escape(title)}</a>{items(children) if children else ""}</li>'
+                                for title, href, children in entries) + "</ol>"
+    # Links under h2 sections have no children of their own.
+    entries = [(title, href, [(h2_title, h2_href, [(h3_title, h3_href, []) for h3_title, h3_href in links])
+                              for h2_title, h2_href, links in sections])
+               for title, href, sections in toc]
+    return items(entries)
+
+def render_html(document, path):
+    # One HTML page holding the whole book behind a table of contents. Every chapter file becomes a section,
+    # and section ids get their chapter as prefix, since each chapter numbers them from zero.
+    with open(path, "w", encoding="utf-8") as out:
+        out.write(f'<!DOCTYPE html>\n<html lang="{html.escape(document.language)}">\n<head>\n<meta charset="utf-8"/>\n'
+                  f'<title>{html.escape(document.title)}</title>\n<style>{document.css}</style>\n</head>\n<body>\n'
+                  f'<header><h1>{html.escape(document.title)}</h1><p>{html.escape(document.author)}</p></header>\n'
+                  f'<nav id="toc">{toc_html(document.toc)}</nav>\n')
+        for _, file_name, body in document.files:
+            prefix = chapter_anchor(file_name)
+            body = section_id_pattern.sub(lambda m: f' id="{prefix}-{m.group(1)}"', body)
+            body = body_tag_pattern.sub(r"<\1p>", body).replace(' epub:type="pagebreak"', '')
+            out.write(f'<section id="{file_anchor(file_name)}">{body}</section>\n')
+        out.write("</body>\n</html>\n")
+    return path
+
+def render_text(document, path):
+    # Plain text for search: one line per block, with a blank line between chapter files.
+    with open(path, "w", encoding="utf-8") as out:
+        out.write(f"{document.title}\n{document.author}\n")
+        for _, _, body in document.files:
+            text = html.unescape(markup_pattern.sub("", block_end_pattern.sub("\n", body)))
+            lines = [line.strip() for line in text.split("\n")]
+            out.write("\n" + "\n".join(line for line in lines if line) + "\n")
+    return path
+
+RENDERERS = {"html": render_html, "txt": render_text}
+
+def render_book(input_path, metadata_path='metadata.json', cover_path='cover.jpg', targets=TARGETS, output_dir=None, cache_dir=None, **options):
+    # The input is parsed once: the EPUB builder fills a Document, and the other targets are written from it.
+    # The EPUB is built even when it is not a target, into a temporary file.
+    with open(metadata_path, "r", encoding="utf-8") as meta_file:
+        title = json.load(meta_file).get("title", "Untitled Book")
+    base = os.path.join(output_dir or "", title)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    if "epub" in targets:
+        epub_path = f"{base}.epub"
+    else:
+        fd, epub_path = tempfile.mkstemp(suffix=".epub")
+        os.close(fd)
+        options["validate"] = False
+    document = Document()
+    outputs = {}
+    try:
+        if input_path.endswith(".json"):
+            create_epub(input_path, cover_path, cache_dir=cache_dir, metadata_path=metadata_path, output_path=epub_path, document=document, **options)
+        else:
+            create_epub_from_textfile(input_path, metadata_path, cover_path, cache_dir=cache_dir, output_path=epub_path, document=document, **options)
+    finally:
+        if "epub" not in targets:
+            os.remove(epub_path)
+    if "epub" in targets:
+        outputs["epub"] = epub_path
+    for target in targets:
+        if target in RENDERERS:
+            with span(f"render_{target}", files=len(document.files)):
+                outputs[target] = RENDERERS[target](document, f"{base}.{target}")
+            print(f"Created {target.upper()}: {outputs[target]}")
+    return outputs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the EPUB, a single-page HTML preview and a plain-text extract from one parse.")
+    parser.add_argument("input", nargs="?", default="input_pre.txt", help="pre-processed .txt or .json input")
+    parser.add_argument("--metadata", default="metadata.json")
+    parser.add_argument("--cover", default="cover.jpg")
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=list(TARGETS))
+    parser.add_argument("--output-dir", default=None)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    args = parser.parse_args()
+    render_book(args.input, args.metadata, args.cover, args.targets, args.output_dir, args.cache_dir)
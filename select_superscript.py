@@ -1,13 +1,103 @@
 import tkinter as tk
+import tkinter.font as tkfont
 from tkinter import messagebox
-import re
-
-CONTEXT_LENGTH = 30
+import json
+import os
+import queue
+import threading
+from tracing import span
+from footnote_refs import (apply_sup, diff_segments, find_consecutive_chain, iter_tokens, load_report, make_snippet,
+                           relocate_selections, report_path, retokenize, selection_record, selections_path, tagged_path,
+                           year_pattern)
+
+SCAN_BATCH_SIZE = 500
+POLL_INTERVAL_MS = 100
+SAVE_DELAY_MS = 1000
+
+class VirtualListbox(tk.Frame):
+    """
+    A listbox that only holds the rows currently in view. Row texts are fetched with get_text(index)
+    when they scroll into view, and the selection is kept as a set of row indices instead of in the widget.
+    """
+    def __init__(self, master, get_text, on_click, **listbox_options):
+        super().__init__(master)
+        self.get_text = get_text
+        self.on_row_click = on_click
+        self.size = 0
+        self.top = 0
+        self.visible = 1
+        self.selected = set()
+        self.active = None
+
+        self.listbox = tk.Listbox(self, selectmode=tk.MULTIPLE, exportselection=False, **listbox_options)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        # Same line height the Tk listbox uses internally.
+        font = tkfont.Font(font=self.listbox.cget("font"))
+        self.line_height = font.metrics("linespace") + 1 + 2 * int(self.listbox.cget("selectborderwidth"))
+
+        self.listbox.bind("<Configure>", self.on_resize)
+        self.listbox.bind("<Button-1>", self.on_listbox_click)
+        self.listbox.bind("<<ListboxSelect>>", lambda event: self.refresh())
+        self.listbox.bind("<MouseWheel>", lambda event: self.scroll_to(self.top - 3 * (1 if event.delta > 0 else -1)))
+        self.listbox.bind("<Button-4>", lambda event: self.scroll_to(self.top - 3))
+        self.listbox.bind("<Button-5>", lambda event: self.scroll_to(self.top + 3))
+
+    def on_resize(self, event):
+        border = 2 * (int(self.listbox.cget("borderwidth")) + int(self.listbox.cget("highlightthickness")))
+        self.visible = max(1, (event.height - border) // self.line_height)
+        self.scroll_to(self.top)
+
+    def on_listbox_click(self, event):
+        index = self.top + self.listbox.nearest(event.y)
+        if index < self.size:
+            self.on_row_click(index)
+        # Return "break" to prevent the default behavior (which might require a second click).
+        return "break"
 
-def to_bold(num_str):
-    bold_digits = {'0': '𝟎', '1': '𝟏', '2': '𝟐', '3': '𝟑', '4': '𝟒', '5': '𝟓', 
-                   '6': '𝟔', '7': '𝟕', '8': '𝟖', '9': '𝟗'}
-    return ''.join(bold_digits.get(ch, ch) for ch in num_str)
+    def yview(self, *args):
+        if args[0] == "moveto":
+            self.scroll_to(int(float(args[1]) * self.size))
+        elif args[0] == "scroll":
+            step = self.visible if args[2] == "pages" else 1
+            self.scroll_to(self.top + int(args[1]) * step)
+
+    def scroll_to(self, top):
+        self.top = max(0, min(top, self.size - self.visible))
+        self.refresh()
+
+    def see(self, index):
+        if index < self.top:
+            self.scroll_to(index)
+        elif index >= self.top + self.visible:
+            self.scroll_to(index - self.visible + 1)
+
+    def set_size(self, size):
+        self.size = size
+        self.scroll_to(self.top)
+
+    def reset(self):
+        self.selected = set()
+        self.active = None
+        self.top = 0
+        self.set_size(0)
+
+    def refresh(self):
+        end = min(self.size, self.top + self.visible + 1)
+        self.listbox.delete(0, tk.END)
+        if end > self.top:
+            self.listbox.insert(tk.END, *(self.get_text(i) for i in range(self.top, end)))
+        for i in range(self.top, end):
+            if i in self.selected:
+                self.listbox.selection_set(i - self.top)
+        if self.active is not None and self.top <= self.active < end:
+            self.listbox.activate(self.active - self.top)
+        if self.size:
+            self.scrollbar.set(self.top / self.size, min(1.0, (self.top + self.visible) / self.size))
+        else:
+            self.scrollbar.set(0.0, 1.0)
 
 class FootnoteSelector(tk.Tk):
     def __init__(self):
@@ -15,9 +105,21 @@ class FootnoteSelector(tk.Tk):
         self.title("Footnote Reference Selector")
         self.geometry("900x600")
         self.filename = "input_pre.txt"
-        self.load_file()
-        self.extract_tokens()
+        self.tokens = []
+        self.number_index = {}
+        self.anchor_index = None
+        self.review = set()
+        self.scanning = False
+        self.scan_generation = 0
+        self.save_job = None
+        self.token_queue = queue.Queue()
         self.create_widgets()
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        self.load_file()
+        self.pending_selections = self.load_selections()
+        self.load_report_picks()
+        self.start_token_scan()
+        self.after(POLL_INTERVAL_MS, self.poll_tokens)
 
     def load_file(self):
         try:
@@ -27,73 +129,147 @@ class FootnoteSelector(tk.Tk):
             messagebox.showerror("File Error", f"Could not load {self.filename}:\n{e}")
             self.content = ""
 
-    def is_year(self, text):
-        return bool(re.match(r"^(19[4-9]\d|20[0-2]\d)$", text))
+    def load_report_picks(self):
+        # A report from footnote_refs.py marks the uncertain picks for review. Its picks are also
+        # preselected, unless selections from an earlier session were saved.
+        self.report_picks = {}
+        self.select_report_picks = not self.pending_selections
+        if os.path.exists(report_path(self.filename)):
+            for reference in load_report(self.filename)["references"]:
+                if reference["start"] is not None:
+                    self.report_picks[reference["start"]] = reference["confidence"]
+
+    def load_selections(self):
+        path = selections_path(self.filename)
+        if not os.path.exists(path):
+            return []
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)["selections"]
+
+    def save_selections(self):
+        # Selections are saved by offset with a checksum of their context, so they can be found again after edits.
+        if self.save_job is not None:
+            self.after_cancel(self.save_job)
+            self.save_job = None
+        if self.scanning:
+            return
+        records = [selection_record(self.content, self.tokens[i]) for i in sorted(self.listbox.selected)]
+        try:
+            with open(selections_path(self.filename), "w", encoding="utf-8") as f:
+                json.dump({"selections": records}, f)
+        except Exception as e:
+            messagebox.showerror("Write Error", f"Could not save selections:\n{e}")
 
-    def extract_tokens(self):
-        self.tokens = []
-        # Find ranges of header tags and other HTML tags so that numbers within them are ignored.
-        header_ranges = [(m.start(), m.end()) for m in re.finditer(r"<h[123]>.*?</h[123]>", self.content, re.DOTALL)]
-        tag_ranges = [(m.start(), m.end()) for m in re.finditer(r"<[^>]+>", self.content)]
-        pattern = re.compile(r"\d+")
+    def schedule_save(self):
+        if self.save_job is not None:
+            self.after_cancel(self.save_job)
+        self.save_job = self.after(SAVE_DELAY_MS, self.save_selections)
 
-        # List of forbidden substrings that if found immediately after the number cause exclusion.
-        forbidden = [" Millionen", " million", " Prozent", " percent", " pro", " 000", "000"]
+    def is_year(self, text):
+        return bool(year_pattern.match(text))
 
-        for m in pattern.finditer(self.content):
-            # Skip if the found number falls within a header or tag.
-            if any(start <= m.start() <= end for start, end in header_ranges + tag_ranges):
+    def start_token_scan(self, previous=None):
+        # Tokens are extracted in a worker thread and handed to the Tk main loop in batches through a queue.
+        # With the previous text and its tokens, only the regions that changed are tokenized again.
+        self.scan_generation += 1
+        self.tokens = []
+        self.number_index = {}
+        self.anchor_index = None
+        self.review = set()
+        self.scanning = True
+        self.listbox.reset()
+        self.update_status()
+        threading.Thread(target=self.scan_tokens, args=(self.content, self.scan_generation, previous), daemon=True).start()
+
+    def scan_tokens(self, content, generation, previous):
+        with span("scan_tokens", incremental=bool(previous)) as info:
+            if previous:
+                old_content, old_tokens = previous
+                with span("diff_segments"):
+                    segments = diff_segments(old_content, content)
+                with span("retokenize"):
+                    tokens = retokenize(old_content, content, old_tokens, segments)
+            else:
+                segments = None
+                tokens = iter_tokens(content)
+            batch = []
+            count = 0
+            for token in tokens:
+                if generation != self.scan_generation:
+                    return
+                batch.append(token)
+                count += 1
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    self.token_queue.put((generation, batch, None))
+                    batch = []
+            info["tokens"] = count
+        self.token_queue.put((generation, batch, None))
+        self.token_queue.put((generation, None, segments))
+
+    def poll_tokens(self):
+        added = False
+        while True:
+            try:
+                generation, batch, segments = self.token_queue.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.scan_generation:
                 continue
-
-            num_str = m.group()
-            num_val = int(num_str) if num_str.isdigit() else None
-
-            if num_val is None or self.is_year(num_str):
+            if batch is None:
+                self.scanning = False
+                self.restore_selections(segments)
                 continue
-
-            # Check the text immediately following the number for any forbidden substrings.
-            following_text = self.content[m.end():m.end() + CONTEXT_LENGTH]
-            if any(forbidden_str in following_text for forbidden_str in forbidden):
-                continue  # Skip this token entirely if any forbidden phrase is found.
-
-            # Create a snippet of context with the number bolded.
-            snippet = (self.content[max(0, m.start() - 33):m.start()] +
-                       to_bold(num_str) +
-                       self.content[m.end():min(len(self.content), m.end() + CONTEXT_LENGTH)])
-            snippet = snippet.replace("\n", " ")
-
-            # Add the token as a dictionary with several fields.
-            self.tokens.append({
-                "start": m.start(),
-                "end": m.end(),
-                "number": num_val,
-                "text": num_str,
-                "snippet": snippet,
-                "is_year": False
-            })
+            for token in batch:
+                index = len(self.tokens)
+                self.number_index.setdefault(token["number"], []).append(index)
+                self.tokens.append(token)
+                confidence = self.report_picks.get(token["start"])
+                if confidence:
+                    if self.select_report_picks:
+                        self.listbox.selected.add(index)
+                    if confidence != "high":
+                        self.review.add(index)
+            added = True
+        if added:
+            self.listbox.set_size(len(self.tokens))
+            # The chain from the current anchor may continue into the tokens that just arrived.
+            if self.anchor_index is not None:
+                self.select_from_anchor(self.anchor_index)
+        self.update_status()
+        self.after(POLL_INTERVAL_MS, self.poll_tokens)
+
+    def restore_selections(self, segments):
+        if self.pending_selections:
+            self.listbox.selected |= relocate_selections(self.content, self.tokens, self.number_index, self.pending_selections, segments)
+            self.pending_selections = []
+            self.listbox.refresh()
+
+    def update_status(self):
+        text = f"{len(self.tokens)} tokens"
+        if self.review:
+            text += f", {len(self.review)} to review"
+        if self.scanning:
+            text += " (scanning...)"
+        self.status.config(text=text)
+
+    def row_text(self, index):
+        token = self.tokens[index]
+        marker = "? " if index in self.review else "  "
+        return marker + make_snippet(self.content, token["start"], token["end"])
+
+    def next_review(self):
+        current = self.listbox.active if self.listbox.active is not None else -1
+        following = [i for i in self.review if i > current]
+        if following:
+            self.listbox.active = min(following)
+            self.listbox.see(self.listbox.active)
+            self.listbox.refresh()
 
     def create_widgets(self):
-        frame = tk.Frame(self)
-        frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
-
-        # The listbox displays a snippet for each token.
-        # Note: The selection mode remains MULTIPLE so that previously selected tokens (before the anchor)
-        # can be preserved. A click handler is added to ensure that a single click immediately selects the item.
-        self.listbox = tk.Listbox(frame, selectmode=tk.MULTIPLE, font=("Consolas", 10), exportselection=False)
-        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-
-        # Bind the custom click event so that a single click activates and selects an item immediately.
-        self.listbox.bind("<Button-1>", self.on_click)
-
-        # Also keep the existing binding for selection-change events.
-        self.listbox.bind("<<ListboxSelect>>", self.on_selection_change)
-
-        scrollbar = tk.Scrollbar(frame, orient=tk.VERTICAL, command=self.listbox.yview)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        self.listbox.config(yscrollcommand=scrollbar.set)
-
-        for token in self.tokens:
-            self.listbox.insert(tk.END, token["snippet"])
+        # The list displays a snippet for each token. Only the rows in view exist in the widget.
+        # Previously selected tokens (before the anchor) are preserved, and a single click immediately selects an item.
+        self.listbox = VirtualListbox(self, self.row_text, self.on_click, font=("Consolas", 10))
+        self.listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
         button_frame = tk.Frame(self)
         button_frame.pack(fill=tk.X, padx=10, pady=5)
@@ -104,25 +280,22 @@ class FootnoteSelector(tk.Tk):
         reload_button = tk.Button(button_frame, text="Reload File", command=self.reload_file)
         reload_button.pack(side=tk.LEFT, padx=5)
 
-        quit_button = tk.Button(button_frame, text="Quit", command=self.destroy)
+        review_button = tk.Button(button_frame, text="Next Review", command=self.next_review)
+        review_button.pack(side=tk.LEFT, padx=5)
+
+        self.status = tk.Label(button_frame, anchor=tk.W)
+        self.status.pack(side=tk.LEFT, padx=5)
+
+        quit_button = tk.Button(button_frame, text="Quit", command=self.close)
         quit_button.pack(side=tk.RIGHT, padx=5)
 
-    def on_click(self, event):
+    def on_click(self, index):
         """
         This handler forces immediate selection on a single mouse click.
-        It determines which item was clicked, activates and selects it,
-        and then calls the forward selection logic.
+        The clicked item becomes the anchor for the forward selection logic.
         """
-        # Determine the index corresponding to the vertical position of the click.
-        index = self.listbox.nearest(event.y)
-        # Activate the clicked item.
-        self.listbox.activate(index)
-        # Ensure the clicked item is selected.
-        self.listbox.selection_set(index)
-        # Call the selection-change handler to update the rest of the selections.
-        self.on_selection_change(None)
-        # Return "break" to prevent the default behavior (which might require a second click).
-        return "break"
+        self.listbox.active = index
+        self.select_from_anchor(index)
 
     def find_forward_consecutive_indices(self, anchor_index):
         """
@@ -130,32 +303,12 @@ class FootnoteSelector(tk.Tk):
         anchor_number+1 in a subsequent token. Then, from that found token, search for anchor_number+2,
         and so on. Return a list of indices (in the tokens list) of the tokens that match this sequence.
         """
-        result_indices = []
-        anchor_token = self.tokens[anchor_index]
-        anchor_number = anchor_token["number"]
-        next_expected = anchor_number + 1
-        current_search_start = anchor_index + 1
-
-        # Continue searching until either the end is reached or the expected number is not found.
-        while current_search_start < len(self.tokens):
-            found = False
-            for i in range(current_search_start, len(self.tokens)):
-                token = self.tokens[i]
-                if token["number"] == next_expected:
-                    result_indices.append(i)
-                    next_expected += 1
-                    current_search_start = i + 1  # Restart search after the found token.
-                    found = True
-                    break  # Only select the first occurrence of the expected number.
-            if not found:
-                break
-        return result_indices
+        return find_consecutive_chain(self.tokens, self.number_index, anchor_index)
 
-    def on_selection_change(self, event):
+    def select_from_anchor(self, anchor_index):
         """
-        This event handler is triggered when the selection changes.
         It implements the following algorithm:
-          1. Determine the anchor token (the one the user clicked).
+          1. The anchor token is the one the user clicked.
           2. Leave any tokens before (or including) the anchor selected.
           3. Clear any selections after the anchor.
           4. Starting from the token immediately after the anchor, search sequentially for the first
@@ -163,60 +316,23 @@ class FootnoteSelector(tk.Tk):
           5. Then, from immediately after that found token, search for a token with (anchor_number + 2),
              and so on until no matching token is found.
         """
-        # Temporarily unbind the event to avoid recursive calls during selection changes.
-        self.listbox.unbind("<<ListboxSelect>>")
-        try:
-            selected_indices = list(self.listbox.curselection())
-            if not selected_indices:
-                return
-
-            # Determine the anchor token index. If possible, use the currently active item.
-            try:
-                anchor_index = self.listbox.index(tk.ACTIVE)
-            except Exception:
-                anchor_index = max(selected_indices)
-
-            # Ensure the anchor index is among the selections.
-            if anchor_index not in selected_indices:
-                selected_indices.append(anchor_index)
-
-            # Clear any selections that occur after the anchor index.
-            for i in range(anchor_index + 1, len(self.tokens)):
-                self.listbox.selection_clear(i)
-
-            # Retrieve the forward indices that match the consecutive sequence.
-            forward_indices = self.find_forward_consecutive_indices(anchor_index)
-            for idx in forward_indices:
-                self.listbox.selection_set(idx)
-
-        finally:
-            # Re-bind the selection-change event.
-            self.listbox.bind("<<ListboxSelect>>", self.on_selection_change)
+        self.anchor_index = anchor_index
+        selected = {i for i in self.listbox.selected if i < anchor_index}
+        selected.add(anchor_index)
+        selected.update(self.find_forward_consecutive_indices(anchor_index))
+        self.listbox.selected = selected
+        self.listbox.refresh()
+        self.schedule_save()
 
     def apply_sup_tags(self):
-        selected_indices = self.listbox.curselection()
+        selected_indices = self.listbox.selected
         if not selected_indices:
             messagebox.showinfo("No Selection", "No tokens selected. Please select tokens to wrap in <sup> tags.")
             return
 
-        # Sort the selected tokens by their position in the original content.
-        selected_tokens = [self.tokens[i] for i in selected_indices]
-        selected_tokens.sort(key=lambda t: t["start"])
-
-        result_parts = []
-        current_index = 0
-
-        for token in selected_tokens:
-            start, end = token["start"], token["end"]
-            result_parts.append(self.content[current_index:start])
-            result_parts.append(f"<sup>{token['text']}</sup>")
-            current_index = end
-
-        result_parts.append(self.content[current_index:])
-        new_text = "".join(result_parts)
-        output_filename = self.filename.replace(".txt", "_s.txt")
-
+        new_text = apply_sup(self.content, [self.tokens[i] for i in selected_indices])
         try:
+            output_filename = tagged_path(self.filename)
             with open(output_filename, "w", encoding="utf-8") as f:
                 f.write(new_text)
             messagebox.showinfo("Success", f"Processed file saved as '{output_filename}'.")
@@ -224,13 +340,19 @@ class FootnoteSelector(tk.Tk):
             messagebox.showerror("Write Error", f"Could not write output file:\n{e}")
 
     def reload_file(self):
+        # Selections move along with the text they belong to. An unfinished scan is simply started over.
+        if not self.scanning:
+            self.pending_selections = [selection_record(self.content, self.tokens[i]) for i in sorted(self.listbox.selected)]
+        previous = None if self.scanning else (self.content, self.tokens)
         self.load_file()
-        self.extract_tokens()
-        self.listbox.delete(0, tk.END)
-        for token in self.tokens:
-            self.listbox.insert(tk.END, token["snippet"])
+        # The report's offsets refer to the text before the edit.
+        self.report_picks = {}
+        self.start_token_scan(previous)
+
+    def close(self):
+        self.save_selections()
+        self.destroy()
 
 if __name__ == '__main__':
     app = FootnoteSelector()
     app.mainloop()
-
@@ -0,0 +1,20 @@
+import os
+from contextlib import contextmanager
+
+def temp_path(path):
+    # Outputs are written under this name first and only replace path once they are complete, so a failed
+    # or interrupted run never leaves a partial file behind. The process id keeps batch workers that write
+    # the same file, such as a shared cache entry, from writing into one temporary file.
+    return f"{path}.{os.getpid()}.tmp"
+
+@contextmanager
+def replacing(path, mode="w", **kwargs):
+    # Opens temp_path(path) for writing, and moves it over path when the block finishes without an error.
+    temp = temp_path(path)
+    try:
+        with open(temp, mode, **kwargs) as f:
+            yield f
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
@@ -0,0 +1,60 @@
+import atexit
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Set EPUB_TRACE to a file name to record spans as a Chrome trace (chrome://tracing, Perfetto),
+# and EPUB_PROFILE to a file name to also write a cProfile dump of the whole run.
+trace_path = None
+events = []
+origin = time.perf_counter()
+
+def max_rss_mb():
+    # Peak resident memory of the process so far. Linux reports kilobytes, macOS bytes.
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(usage / (1e6 if sys.platform == "darwin" else 1024), 1)
+
+def write_trace():
+    with open(trace_path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def enable(trace=None, profile=None):
+    global trace_path
+    if trace and trace_path is None:
+        trace_path = trace
+        atexit.register(write_trace)
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(profiler.dump_stats, profile)
+
+@contextmanager
+def span(name, **args):
+    """
+    Records the time spent in the block. The yielded dict ends up in the trace, so counts can be added to it.
+    When tracing is off, nothing is recorded.
+    """
+    if trace_path is None:
+        yield args
+        return
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        end = time.perf_counter()
+        args["max_rss_mb"] = max_rss_mb()
+        events.append({"name": name, "ph": "X", "ts": round((start - origin) * 1e6), "dur": round((end - start) * 1e6),
+                       "pid": os.getpid(), "tid": threading.get_ident(), "args": args})
+
+if os.environ.get("EPUB_TRACE") or os.environ.get("EPUB_PROFILE"):
+    enable(os.environ.get("EPUB_TRACE"), os.environ.get("EPUB_PROFILE"))
@@ -0,0 +1,157 @@
+import argparse
+import posixpath
+import sys
+import zipfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlsplit
+from lxml import etree
+
+NAMESPACES = {
+    "c": "urn:oasis:names:tc:opendocument:xmlns:container",
+    "opf": "http://www.idpf.org/2007/opf",
+    "x": "http://www.w3.org/1999/xhtml",
+}
+MIMETYPE = b"application/epub+zip"
+DOCUMENT_TYPES = {"application/xhtml+xml", "application/x-dtbncx+xml"}
+xml_parser = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=True)
+
+def parse_xml(data):
+    return etree.fromstring(data, xml_parser)
+
+def check_document(name, data):
+    # Runs in a worker thread, since lxml parses without holding the GIL. Returns the ids and links of
+    # one XHTML or NCX entry along with its problems, or no ids when it cannot be parsed.
+    try:
+        root = parse_xml(data)
+    except etree.XMLSyntaxError as e:
+        return None, [], [f"{name}: not well-formed XML: {e}"]
+    problems = []
+    ids = root.xpath("//@id")
+    duplicates = sorted(id for id, count in Counter(ids).items() if count > 1)
+    if duplicates:
+        problems.append(f"{name}: duplicate ids {', '.join(duplicates[:5])}" + (" ..." if len(duplicates) > 5 else ""))
+    if root.xpath("//x:body//x:body", namespaces=NAMESPACES):
+        problems.append(f"{name}: body element nested inside the body")
+    return set(ids), [str(link) for link in root.xpath("//@href | //@src")], problems
+
+def resolve(base, href):
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base), unquote(href)))
+
+def validate_epub(path, workers=None):
+    # Structural checks of a written EPUB: the mimetype entry, the container and package documents,
+    # manifest and spine, well-formed XHTML without duplicate ids, and links and TOC targets that resolve.
+    # Returns a list of problems, empty for a good book.
+    problems = []
+    try:
+        z = zipfile.ZipFile(path)
+    except zipfile.BadZipFile as e:
+        return [f"not a zip file: {e}"]
+    except OSError as e:
+        return [f"cannot be read: {e}"]
+    with z:
+        infos = z.infolist()
+        names = [info.filename for info in infos]
+        if len(set(names)) != len(names):
+            problems.append("duplicate zip entries " + ", ".join(sorted(n for n, c in Counter(names).items() if c > 1)))
+        if not infos or infos[0].filename != "mimetype":
+            problems.append("mimetype is not the first entry")
+        elif infos[0].compress_type != zipfile.ZIP_STORED or infos[0].extra or z.read("mimetype") != MIMETYPE:
+            problems.append("mimetype entry must be stored uncompressed, without extra field, and read application/epub+zip")
+        try:
+            container = parse_xml(z.read("META-INF/container.xml"))
+            opf_path = container.xpath("//c:rootfile/@full-path", namespaces=NAMESPACES)[0]
+            opf = parse_xml(z.read(opf_path))
+        except (KeyError, IndexError, etree.XMLSyntaxError) as e:
+            problems.append(f"no readable package document: {e}")
+            return problems
+
+        manifest = {}
+        nav = None
+        for item in opf.xpath("/opf:package/opf:manifest/opf:item", namespaces=NAMESPACES):
+            item_id = item.get("id")
+            if item_id in manifest:
+                problems.append(f"manifest: duplicate id {item_id}")
+            target = resolve(opf_path, item.get("href", ""))
+            manifest[item_id] = (target, item.get("media-type"))
+            if target not in z.NameToInfo:
+                problems.append(f"manifest: {item_id} points to missing {target}")
+            if "nav" in (item.get("properties") or "").split():
+                nav = target
+        if nav is None:
+            problems.append("manifest: no nav document")
+        listed = {target for target, _ in manifest.values()}
+        for name in names:
+            if name not in listed and name not in ("mimetype", opf_path) and not name.startswith("META-INF/"):
+                problems.append(f"{name} is not in the manifest")
+        spine = opf.find("opf:spine", NAMESPACES)
+        if spine is None or not len(spine):
+            problems.append("spine is empty")
+        else:
+            toc = spine.get("toc")
+            if toc and toc not in manifest:
+                problems.append(f"spine: toc {toc} is not in the manifest")
+            for itemref in spine:
+                idref = itemref.get("idref")
+                if idref not in manifest:
+                    problems.append(f"spine: {idref} is not in the manifest")
+                elif manifest[idref][1] != "application/xhtml+xml":
+                    problems.append(f"spine: {idref} is not an XHTML document")
+
+        documents = [target for target, media_type in manifest.values() if media_type in DOCUMENT_TYPES and target in z.NameToInfo]
+        contents = [z.read(name) for name in documents]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(check_document, documents, contents))
+
+    ids = {}
+    for name, (document_ids, _, document_problems) in zip(documents, results):
+        ids[name] = document_ids
+        problems.extend(document_problems)
+    for name, (_, links, _) in zip(documents, results):
+        for link in links:
+            parts = urlsplit(link)
+            if parts.scheme or parts.netloc:
+                continue
+            target = resolve(name, parts.path) if parts.path else name
+            if target not in z.NameToInfo:
+                problems.append(f"{name}: link to missing file {link}")
+            elif parts.fragment and ids.get(target) is not None and unquote(parts.fragment) not in ids[target]:
+                problems.append(f"{name}: link to missing id {link}")
+    return problems
+
+class EpubCheckError(Exception):
+    def __init__(self, path, problems):
+        super().__init__(f"{path} failed the EPUB check with {len(problems)} problems: {problems[0]}")
+        self.path = path
+        self.problems = problems
+
+def check_epub(path, limit=20):
+    # Prints the problems found in a freshly written EPUB and returns them, so an empty list means it passed.
+    problems = validate_epub(path)
+    if problems:
+        print(f"EPUB check: {len(problems)} problems in {path}")
+        for problem in problems[:limit]:
+            print(f"  {problem}")
+        if limit is not None and len(problems) > limit:
+            print(f"  ... and {len(problems) - limit} more")
+    return problems
+
+def require_valid_epub(path):
+    # Run by the builders after writing: a book with problems raises EpubCheckError, which fails the build
+    # while the file stays in place for inspection.
+    problems = check_epub(path)
+    if problems:
+        raise EpubCheckError(path, problems)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the structure of EPUB files.")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--all", action="store_true", help="list every problem instead of the first 20")
+    args = parser.parse_args()
+    failed = 0
+    for path in args.paths:
+        if check_epub(path, None if args.all else 20):
+            failed += 1
+        else:
+            print(f"OK {path}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,50 @@
+import argparse
+import os
+import time
+from chapter_cache import MemoryChapterCache
+from create_epub import create_epub_from_textfile
+from page_numbering import page_index_path
+
+def snapshot(paths):
+    return {path: os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in paths}
+
+def watch(input_path='input_pre.txt', metadata_path='metadata.json', cover_path='cover.jpg', interval=0.2, debounce=0.3, compress_level=1):
+    # Rebuilds the EPUB whenever one of the inputs changes. Chapters are kept in memory between builds,
+    # so only the chapters around an edit are parsed and rendered again. The output is only for review,
+    # so it is compressed at the fastest level by default.
+    paths = [input_path, page_index_path(input_path), metadata_path, cover_path]
+    cache = MemoryChapterCache()
+    built = None
+    print(f"Watching {input_path}, {metadata_path} and {cover_path}")
+    while True:
+        current = snapshot(paths)
+        if current != built:
+            # Wait until the files stop changing, since editors often save in several steps.
+            while True:
+                time.sleep(debounce)
+                settled = snapshot(paths)
+                if settled == current:
+                    break
+                current = settled
+            start = time.perf_counter()
+            try:
+                create_epub_from_textfile(input_path, metadata_path, cover_path, cache=cache, compress_level=compress_level)
+                print(f"Rebuilt in {time.perf_counter() - start:.2f} s")
+            except Exception as e:
+                print(f"Build failed: {e}")
+            built = current
+        time.sleep(interval)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the EPUB whenever the input, metadata or cover changes.")
+    parser.add_argument("input", nargs="?", default="input_pre.txt")
+    parser.add_argument("--metadata", default="metadata.json")
+    parser.add_argument("--cover", default="cover.jpg")
+    parser.add_argument("--interval", type=float, default=0.2, help="seconds between checks")
+    parser.add_argument("--debounce", type=float, default=0.3, help="seconds the files must stay unchanged before a rebuild")
+    parser.add_argument("--compress-level", type=int, default=1, choices=range(10), help="deflate level of the EPUB, 1 fastest, 9 smallest")
+    args = parser.parse_args()
+    try:
+        watch(args.input, args.metadata, args.cover, args.interval, args.debounce, args.compress_level)
+    except KeyboardInterrupt:
+        pass